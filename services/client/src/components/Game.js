@@ -8,6 +8,7 @@ import Chat from "./Chat";
 import IconButton from "@material-ui/core/IconButton";
 import UserList from "./UserList";
 import {userService} from "./userService";
+import {BINARY_FORMAT, wireFormat} from "./wireFormat";
 
 // SocketIO data.
 // const ENDPOINT = "http://localhost:5000";
@@ -20,6 +21,41 @@ function TileSelection(name, amount) {
 
 let hexGrid = new HexGrid();
 
+// Last known state of the board according to the server, kept up to date with the moves sent since.
+let boardSync = {
+    epoch: null,
+    sequence: 0,
+    tiles: {}
+};
+
+function popTile(tiles, x, y) {
+    let stack = tiles[y][x];
+    stack.pop();
+    if (stack.length === 0) delete tiles[y][x];
+}
+
+function applyBoardDelta(delta) {
+    let tiles = boardSync.tiles;
+    if (delta.action === "remove") {
+        // A placement which was taken back.
+        popTile(tiles, delta.x, delta.y);
+        return;
+    }
+    if (delta.action === "move") {
+        popTile(tiles, delta.from_x, delta.from_y);
+    }
+
+    if (tiles[delta.y] === undefined) tiles[delta.y] = {};
+    if (tiles[delta.y][delta.x] === undefined) tiles[delta.y][delta.x] = [];
+    tiles[delta.y][delta.x].push({
+        x: delta.x,
+        y: delta.y,
+        z: delta.z,
+        owner: delta.owner,
+        type: delta.type
+    });
+}
+
 const chatData = {
     socket: socket
 };
@@ -42,6 +78,7 @@ export default function Game() {
     const [cookies, setCookie, removeCookie] = useCookies(['room']);
     const [room, setRoom] = useState("");
     const [isConnected, setIsConnected] = useState(false);
+    const [isSearching, setIsSearching] = useState(false);
 
     useEffect(() => {
         // Register canvas and load resources.
@@ -61,6 +98,13 @@ export default function Game() {
         if (rm !== undefined) {
             setRoom(rm);
         }
+
+        // The server made a room for us and an opponent, in which we are already seated.
+        socket.on("matchFound", (response) => {
+            setIsSearching(false);
+            setRoom(response.room);
+            connectGame(response.room);
+        });
     }, []);
 
     function buttonDisconnectGame() {
@@ -70,6 +114,24 @@ export default function Game() {
         setIsConnected(false);
     }
 
+    function buttonTakeback() {
+        let username = userService.getUser().name;
+        socket.emit("takeback", {room: room, username: username});
+    }
+
+    function buttonFindMatch() {
+        // Reconnect socket to ensure correct login is used.
+        socket.disconnect();
+        socket.connect();
+        socket.emit("findMatch");
+        setIsSearching(true);
+    }
+
+    function buttonCancelMatch() {
+        socket.emit("cancelMatch");
+        setIsSearching(false);
+    }
+
     function buttonConnectGame() {
         // Reconnect socket to ensure correct login is used.
         socket.disconnect();
@@ -89,7 +151,10 @@ export default function Game() {
 
         // Setup game_socket event listeners and join the selected room.
         socket.emit("join", {
-            room: room
+            room: room,
+            epoch: boardSync.epoch,
+            sequence: boardSync.sequence,
+            format: BINARY_FORMAT
         });
 
         socket.on("userList", (response) => {
@@ -100,8 +165,28 @@ export default function Game() {
         });
 
         socket.on("boardState", (rawResponse) => {
-            let response = JSON.parse(rawResponse);
-            hexGrid.setBoardState(response);
+            // Binary unless the server only supports JSON.
+            if (rawResponse instanceof ArrayBuffer) {
+                boardSync = wireFormat.decodeBoardState(rawResponse);
+            } else {
+                boardSync = JSON.parse(rawResponse);
+            }
+            hexGrid.setBoardState(boardSync.tiles);
+        });
+
+        socket.on("boardDelta", (response) => {
+            if (response.epoch !== boardSync.epoch) return;
+
+            for (let delta of response.deltas) {
+                if (delta.sequence <= boardSync.sequence) continue;
+                applyBoardDelta(delta);
+                boardSync.sequence = delta.sequence;
+            }
+            hexGrid.setBoardState(boardSync.tiles);
+        });
+
+        socket.on("pinnedTiles", (response) => {
+            hexGrid.setPinnedTiles(response);
         });
 
         socket.on("tileAmounts", (response) => {
@@ -119,6 +204,10 @@ export default function Game() {
         });
 
         socket.on("placeTile", (response) => {
+            if (response instanceof ArrayBuffer) {
+                response = wireFormat.decodePlaceTile(response);
+            }
+
             hexGrid.audio_files["tile_sound_2"].currentTime = 0.0;
             hexGrid.audio_files["tile_sound_2"].play();
 
@@ -162,7 +251,11 @@ export default function Game() {
         });
 
         socket.on("markedTiles", (rawResponse) => {
-            hexGrid.markedTiles = JSON.parse(rawResponse);
+            if (rawResponse instanceof ArrayBuffer) {
+                hexGrid.markedTiles = wireFormat.decodeMarkedTiles(rawResponse);
+            } else {
+                hexGrid.markedTiles = JSON.parse(rawResponse);
+            }
         });
 
         hexGrid.onTilePlaceHandler = (tile) => {
@@ -233,7 +326,9 @@ export default function Game() {
             )
         }, 1000 / 30);
 
-        setInterval(() => { socket.emit("getBoard", {room: room}); }, 1000/30);
+        setInterval(() => {
+            socket.emit("getBoard", {room: room, epoch: boardSync.epoch, sequence: boardSync.sequence});
+        }, 1000/30);
 
         setIsConnected(true);
     }
@@ -275,6 +370,11 @@ export default function Game() {
                 {!isConnected ? <Button onClick={buttonConnectGame} variant="contained">Connect</Button>
                     : <Button onClick={buttonDisconnectGame} variant="contained">Disconnect</Button>
                 }
+                {isConnected && <Button onClick={buttonTakeback} variant="contained">Take back</Button>}
+                {!isConnected && (!isSearching
+                    ? <Button onClick={buttonFindMatch} variant="contained">Find match</Button>
+                    : <Button onClick={buttonCancelMatch} variant="contained">Cancel search</Button>)
+                }
             </div>
             <UserList data={{
                 socket: socket,
@@ -39,6 +39,8 @@ export function HexGrid() {
 
     this.boardState = {};
     this.markedTiles = [];
+    // Positions of tiles which cannot be picked up without breaking the hive, as "x,y" keys.
+    this.pinnedTiles = new Set();
 
     this.images = {};
     this.audio_files = {};
@@ -308,6 +310,14 @@ export function HexGrid() {
         this.boardState[y][x].push(tile);
     };
 
+    this.setPinnedTiles = function(data) {
+        this.pinnedTiles = new Set(data.map((entry) => entry.x + "," + entry.y));
+    };
+
+    this.isPinned = function(x, y) {
+        return this.pinnedTiles.has(x + "," + y);
+    };
+
     this.tileClickHandler = function(self, ev, tile) {
         // Local onclick handler for tiles.
         // E.g. sound files can be played here.
@@ -389,7 +399,7 @@ export function HexGrid() {
             if (this.selection === null) {
                 // If no tile is yet selected, select the currently hovering tile.
                 let tile = this.getTile(point.x, point.y);
-                if (tile !== null && tile.mine) {
+                if (tile !== null && tile.mine && !this.isPinned(point.x, point.y)) {
                     tile.callback(this, ev, tile);
                     this.onTilePickupHandler(tile);
                 }
@@ -440,9 +450,16 @@ export function HexGrid() {
         this.context.stroke();
         this.context.fill();
 
+        // Grey out tiles which cannot be moved.
+        let pinned = tile.x !== null && this.isPinned(tile.x, tile.y)
+            && this.getTile(tile.x, tile.y) === tile;
+        if (pinned) this.context.globalAlpha = 0.4;
+
         let s = this.hexSize / 2;
         this.context.drawImage(this.images[tile.image],
             x - s, y - s - tileThickness * (tile.z + 1), this.hexSize, this.hexSize);
+
+        this.context.globalAlpha = 1.0;
     };
 
     this.getNeighbours = function(point) {
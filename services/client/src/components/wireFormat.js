@@ -0,0 +1,118 @@
+// Decoders for the binary format of the boardState, markedTiles and placeTile events.
+// Numbers are little endian, strings are prefixed with their length in bytes.
+
+// Piece codes, in the same order as the server.
+const PIECES = ["queen", "spider", "beetle", "grasshopper", "ant", "mosquito", "ladybug"];
+
+const textDecoder = new TextDecoder();
+
+export const BINARY_FORMAT = "binary";
+
+export const wireFormat = {
+    decodeBoardState,
+    decodeMarkedTiles,
+    decodePlaceTile
+};
+
+
+function Reader(buffer) {
+    this.view = new DataView(buffer);
+    this.offset = 0;
+
+    this.uint8 = function() {
+        let value = this.view.getUint8(this.offset);
+        this.offset += 1;
+        return value;
+    };
+
+    this.uint16 = function() {
+        let value = this.view.getUint16(this.offset, true);
+        this.offset += 2;
+        return value;
+    };
+
+    this.int16 = function() {
+        let value = this.view.getInt16(this.offset, true);
+        this.offset += 2;
+        return value;
+    };
+
+    this.uint32 = function() {
+        let value = this.view.getUint32(this.offset, true);
+        this.offset += 4;
+        return value;
+    };
+
+    this.bytes = function(length) {
+        let value = new Uint8Array(this.view.buffer, this.view.byteOffset + this.offset, length);
+        this.offset += length;
+        return value;
+    };
+
+    this.string = function() {
+        return textDecoder.decode(this.bytes(this.uint16()));
+    };
+}
+
+
+function decodeBoardState(buffer) {
+    let reader = new Reader(buffer);
+
+    let epoch = Array.from(reader.bytes(16), (byte) => byte.toString(16).padStart(2, "0")).join("");
+    let sequence = reader.uint32();
+
+    let owners = [];
+    let ownerCount = reader.uint8();
+    for (let i = 0; i < ownerCount; i++) {
+        owners.push(reader.string());
+    }
+
+    // Tiles arrive from the bottom to the top of their stack.
+    let tiles = {};
+    let tileCount = reader.uint16();
+    for (let i = 0; i < tileCount; i++) {
+        let x = reader.int16();
+        let y = reader.int16();
+        let z = reader.uint8();
+        let type = PIECES[reader.uint8()];
+        let owner = owners[reader.uint8()];
+
+        if (tiles[y] === undefined) tiles[y] = {};
+        if (tiles[y][x] === undefined) tiles[y][x] = [];
+        tiles[y][x].push({x: x, y: y, z: z, owner: owner, type: type});
+    }
+
+    return {
+        epoch: epoch,
+        sequence: sequence,
+        tiles: tiles
+    };
+}
+
+
+function decodeMarkedTiles(buffer) {
+    let reader = new Reader(buffer);
+
+    let tiles = [];
+    let count = reader.uint16();
+    for (let i = 0; i < count; i++) {
+        tiles.push({x: reader.int16(), y: reader.int16(), z: reader.uint8()});
+    }
+    return tiles;
+}
+
+
+function decodePlaceTile(buffer) {
+    let reader = new Reader(buffer);
+
+    let username = reader.string();
+    return {
+        username: username,
+        data: {
+            x: reader.int16(),
+            y: reader.int16(),
+            z: reader.uint8(),
+            image: PIECES[reader.uint8()]
+        }
+    };
+}
@@ -0,0 +1,311 @@
+#
+# Move generator benchmark and perft counter.
+#
+# Builds a corpus of seeded random games, and for positions along those games counts the leaves of the legal move
+# tree up to a depth (perft) and times the move generation functions of the board. The last games start at the limit
+# of the coordinates, where moves beyond MAX_COORDINATE must not be generated.
+# The node counts are stored in the corpus, so a run which counts different nodes points at a move generation bug.
+#
+# Run from services/server:
+#   python -m benchmarks.perft generate --games 16 --seed 1
+#   python -m benchmarks.perft run
+#
+import argparse
+import os
+import random
+import sys
+import time
+
+from project.game.Board import Board
+from project.game.Player import DetachedUser
+from project.game.grid import MAX_COORDINATE, cell_id
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), "corpus.txt")
+
+# Positions along a game which are benchmarked, every CHECKPOINT_INTERVAL plies.
+CHECKPOINT_INTERVAL = 6
+
+# Where the first tile of the edge games is placed, so their hive grows against the limits of the coordinates.
+# It is one cell away from the corner, in the corner the second tile can leave the first player no cell to place on.
+EDGE_ORIGIN = (MAX_COORDINATE - 1, 1 - MAX_COORDINATE)
+
+PIECE_LETTERS = {
+    "queen": "Q",
+    "spider": "S",
+    "beetle": "B",
+    "grasshopper": "G",
+    "ant": "A",
+    "mosquito": "M",
+    "ladybug": "L"
+}
+LETTER_PIECES = dict((letter, piece) for piece, letter in PIECE_LETTERS.items())
+
+
+def new_board() -> Board:
+    board = Board()
+    board.add_player(DetachedUser("white"))
+    board.add_player(DetachedUser("black"))
+    return board
+
+
+def encode_move(data: dict) -> str:
+    """
+    Writes the data of a placeTile request as e.g. "A1,0" for a placement, or "A1,0>3,0" for a movement.
+
+    :param data:
+    :return:
+    """
+    target = "%d,%d" % (data["new_x"], data["new_y"])
+    if "x" in data:
+        return "%s%d,%d>%s" % (PIECE_LETTERS[data["image"]], data["x"], data["y"], target)
+    return PIECE_LETTERS[data["image"]] + target
+
+
+def decode_move(text: str) -> dict:
+    piece = LETTER_PIECES[text[0]]
+    cells = [tuple(int(value) for value in cell.split(",")) for cell in text[1:].split(">")]
+
+    data = {"image": piece}
+    data["new_x"], data["new_y"] = cells[-1]
+    if len(cells) == 2:
+        data["x"], data["y"] = cells[0]
+    return data
+
+
+def replay(moves, plies=None) -> Board:
+    """
+    Plays the moves of a corpus game through the validating Board.move.
+
+    :param moves: the encoded moves.
+    :param plies: the amount of moves to play, all of them if None.
+    :return: the board after the moves.
+    """
+    board = new_board()
+    for text in moves[:plies]:
+        if not board.move(board.get_turn(), decode_move(text)):
+            raise ValueError("Corpus move %s is not valid." % text)
+    return board
+
+
+def play_random_game(seed: int, max_plies: int, origin=None) -> list:
+    """
+    Plays random legal moves.
+
+    :param seed:
+    :param max_plies: the most moves played.
+    :param origin: the (x, y) coordinates of the first tile, instead of a random legal placement.
+    :return: the encoded moves.
+    """
+    rng = random.Random(seed)
+    board = new_board()
+    moves = []
+
+    if origin is not None:
+        data = {"image": rng.choice(sorted(board.get_turn().pieces)), "new_x": origin[0], "new_y": origin[1]}
+        if not board.move(board.get_turn(), data):
+            raise ValueError("Generated move %s is not valid." % encode_move(data))
+        moves.append(encode_move(data))
+
+    while len(moves) < max_plies and not board.finished():
+        player = board.get_turn()
+        legal = board.get_legal_moves(player)
+        if not legal:
+            break
+
+        # Sorted, so the game only depends on the seed and not on set ordering.
+        legal.sort(key=lambda move: (move[0], -1 if move[1] is None else move[1], move[2]))
+        piece, origin, target = rng.choice(legal)
+        data = {"image": piece}
+        data["new_x"], data["new_y"] = board.get_coordinates(target)
+        if origin is not None:
+            data["x"], data["y"] = board.get_coordinates(origin)
+
+        if not board.move(player, data):
+            raise ValueError("Generated move %s is not valid." % encode_move(data))
+        moves.append(encode_move(data))
+
+    return moves
+
+
+def is_terminal(board) -> bool:
+    return any(amount == 6 for amount in board.get_queen_neighbours().values())
+
+
+def perft(board, depth: int) -> int:
+    """
+    Counts the move sequences of the given length from the position, games end when a queen is surrounded.
+
+    :param board:
+    :param depth:
+    :return:
+    """
+    if is_terminal(board):
+        return 0
+
+    player = board.get_turn()
+    moves = board.get_legal_moves(player)
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    for move in moves:
+        undo = board.make_move(player, *move)
+        nodes += perft(board, depth - 1)
+        board.unmake_move(undo)
+    return nodes
+
+
+def checkpoints(moves) -> range:
+    return range(CHECKPOINT_INTERVAL, len(moves) + 1, CHECKPOINT_INTERVAL)
+
+
+def generate(path, games, edge_games, seed, max_plies, depth):
+    lines = [
+        "# Hive perft corpus, see benchmarks/perft.py.",
+        "# game <seed> <moves>: placements are written as <piece><x>,<y>, movements as <piece><x>,<y>><x>,<y>.",
+        "# perft <game> <plies> <depth> <nodes>: leaf count of the legal move tree after the first plies of a game.",
+    ]
+
+    for game in range(games + edge_games):
+        game_seed = seed + game
+        moves = play_random_game(game_seed, max_plies, EDGE_ORIGIN if game >= games else None)
+        lines.append("game %d %s" % (game_seed, " ".join(moves)))
+
+        for plies in checkpoints(moves):
+            board = replay(moves, plies)
+            lines.append("perft %d %d %d %d" % (game, plies, depth, perft(board, depth)))
+
+    with open(path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+    print("Wrote %d games to %s" % (games + edge_games, path))
+
+
+def load(path):
+    games = []
+    counts = []
+    with open(path) as file:
+        for line in file:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if fields[0] == "game":
+                games.append(fields[2:])
+            elif fields[0] == "perft":
+                counts.append(tuple(int(value) for value in fields[1:]))
+    return games, counts
+
+
+class Timer:
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def time(self, name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+        self.calls[name] = self.calls.get(name, 0) + 1
+        return result
+
+    def report(self):
+        for name in sorted(self.seconds):
+            seconds = self.seconds[name]
+            calls = self.calls[name]
+            print("%-36s %8d calls %10.1f us/call %10.0f calls/s"
+                  % (name, calls, seconds / calls * 1e6, calls / seconds if seconds else 0.0))
+
+
+def time_position(board, timer):
+    """
+    Times the move generation functions on every tile of the position, with the caches of the board cleared.
+
+    :param board:
+    :param timer:
+    :return:
+    """
+    player = board.get_turn()
+
+    board.clear_caches()
+    timer.time("get_valid_moves (placement)", board.get_valid_moves, None, player)
+    timer.time("finished", board.finished)
+
+    for tile in board.get_top_tiles():
+        board.clear_caches()
+        if timer.time("breaks_hive", board.breaks_hive, tile):
+            continue
+
+        owner = board.get_player(tile.owner)
+        board.clear_caches()
+        timer.time("get_valid_moves", board.get_valid_moves, tile, owner)
+
+        # Only the rules of the piece itself, on the board as it is while the tile is moved.
+        origin = cell_id(tile.x, tile.y)
+        with board.lifted(origin):
+            timer.time("get_piece_moves (%s)" % tile.type, board.get_piece_moves, tile.type, origin)
+
+    board.clear_caches()
+    timer.time("get_legal_moves", board.get_legal_moves, player)
+
+    # Copying the position, in process and for worker processes.
+    timer.time("clone", board.clone)
+    timer.time("snapshot", board.snapshot)
+
+
+def run(path, depth):
+    games, counts = load(path)
+    timer = Timer()
+    failures = 0
+    nodes = 0
+    perft_seconds = 0.0
+
+    for game, plies, stored_depth, stored_nodes in counts:
+        board = replay(games[game], plies)
+        time_position(board, timer)
+
+        if depth is not None and depth != stored_depth:
+            continue
+
+        start = time.perf_counter()
+        counted = perft(board, stored_depth)
+        perft_seconds += time.perf_counter() - start
+        nodes += counted
+
+        if counted != stored_nodes:
+            failures += 1
+            print("Mismatch in game %d after %d plies: perft(%d) is %d, expected %d"
+                  % (game, plies, stored_depth, counted, stored_nodes))
+
+    print("%d positions from %d games" % (len(counts), len(games)))
+    if perft_seconds:
+        print("perft: %d nodes in %.2f s, %.0f nodes/s" % (nodes, perft_seconds, nodes / perft_seconds))
+    timer.report()
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the move generation of the board.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="create a corpus of random games with perft counts")
+    generate_parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    generate_parser.add_argument("--games", type=int, default=16)
+    generate_parser.add_argument("--edge-games", type=int, default=1,
+                                 help="games started at the limit of the coordinates, after the other games")
+    generate_parser.add_argument("--seed", type=int, default=1)
+    generate_parser.add_argument("--plies", type=int, default=60, help="maximum length of a game")
+    generate_parser.add_argument("--depth", type=int, default=2)
+
+    run_parser = commands.add_parser("run", help="time the move generation and check the perft counts")
+    run_parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    run_parser.add_argument("--depth", type=int, default=None, help="only count the positions with this depth")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate(args.corpus, args.games, args.edge_games, args.seed, args.plies, args.depth)
+    elif run(args.corpus, args.depth):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
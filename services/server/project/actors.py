@@ -0,0 +1,119 @@
+#
+# A queue of game events per room.
+#
+# Every room gets a mailbox with a single greenlet running its events one at a time, in the order they arrived.
+# Events of a room never interleave, even when one of them waits on the database or the network, while the events of
+# other rooms keep running. A mailbox without events is closed.
+#
+# A mailbox holds at most max_pending events of clients, a client whose event does not fit is told so through
+# on_rejected. Events of the server itself, such as CPU moves and evictions, have no sender and are always queued.
+# Events which clients repeat over and over, such as polls, are marked droppable: they do not take the place of
+# other events, a sender has at most one of each queued, and they are dropped without notice when the mailbox is full.
+#
+from gevent import spawn
+from gevent.queue import Empty, Queue
+
+DEFAULT_MAX_PENDING = 256
+
+# Seconds a mailbox stays open without events.
+MAILBOX_IDLE_TIMEOUT = 30
+
+
+def droppable(function):
+    """
+    Marks a function whose events can be dropped when the room is busy, as the client sends the next one soon.
+    """
+    function.droppable = True
+    return function
+
+
+class _Mailbox:
+    __slots__ = ("queue", "events", "repeated", "dropped")
+
+    def __init__(self):
+        self.queue = Queue()
+        # Queued events which are not droppable.
+        self.events = 0
+        # (function, sender) of the queued droppable events.
+        self.repeated = set()
+        self.dropped = 0
+
+
+class RoomActors:
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING):
+        self.max_pending = max_pending
+        # The app whose context the events run in, if any.
+        self.app = None
+        # Called with the room, the function and the sender of an event which did not fit in the mailbox.
+        self.on_rejected = None
+        self._mailboxes = {}
+
+    def submit(self, room, function, *args, sender=None) -> bool:
+        """
+        Queues a function to be called after all earlier events of the room.
+
+        :param room:
+        :param function:
+        :param args:
+        :param sender: the session id of the client which sent the event, None for events of the server itself.
+        :return: False if the mailbox of the room was full, and the event was dropped.
+        """
+        mailbox = self._mailboxes.get(room)
+        if mailbox is None:
+            mailbox = self._mailboxes[room] = _Mailbox()
+            spawn(self._run, room, mailbox)
+
+        key = None
+        if getattr(function, "droppable", False):
+            if sender is not None:
+                key = (function, sender)
+                # The event still queued answers this one as well.
+                if key in mailbox.repeated:
+                    return True
+            if mailbox.queue.qsize() >= self.max_pending:
+                mailbox.dropped += 1
+                return False
+            if key is not None:
+                mailbox.repeated.add(key)
+        elif sender is not None and mailbox.events >= self.max_pending:
+            mailbox.dropped += 1
+            if self.on_rejected is not None:
+                self.on_rejected(room, function, sender)
+            return False
+        else:
+            mailbox.events += 1
+
+        mailbox.queue.put((function, args, key))
+        return True
+
+    def pending(self, room) -> int:
+        mailbox = self._mailboxes.get(room)
+        return 0 if mailbox is None else mailbox.queue.qsize()
+
+    def _run(self, room, mailbox):
+        while True:
+            try:
+                function, args, key = mailbox.queue.get(timeout=MAILBOX_IDLE_TIMEOUT)
+            except Empty:
+                # Nothing can be queued between the timeout and closing, as neither yields.
+                del self._mailboxes[room]
+                return
+
+            # Once the event runs, the next one of its sender has to be queued to be answered.
+            if key is not None:
+                mailbox.repeated.discard(key)
+            elif not getattr(function, "droppable", False):
+                mailbox.events -= 1
+
+            try:
+                if self.app is None:
+                    function(*args)
+                else:
+                    with self.app.app_context():
+                        function(*args)
+            except Exception as e:
+                print("%s in room %s failed: %s" % (function.__name__, room, e))
+
+            if mailbox.dropped and mailbox.queue.empty():
+                print("Room %s was overloaded, dropped %d events." % (room, mailbox.dropped))
+                mailbox.dropped = 0
@@ -1,9 +1,10 @@
 from flask import request
-from werkzeug.exceptions import Conflict, NotFound
+from werkzeug.exceptions import Conflict, NotFound, ServiceUnavailable
 
 from project.api import api
 from project.database import user_service, request_session
 from project.database.models import UserModel
+from project.passwords import PasswordsBusy
 from project.session import session_user_set
 
 
@@ -17,7 +18,12 @@ def login():
     if user is None:
         return NotFound("This username cannot be found.")
 
-    if user.check_password(password):
+    try:
+        valid = user.check_password(password)
+    except PasswordsBusy:
+        raise ServiceUnavailable("Too many people are logging in, please try again.")
+
+    if valid:
         session_user_set(user)
         return user.to_json()
 
@@ -32,7 +38,10 @@ def register():
     if user is not None:
         raise Conflict("This username already exists.")
 
-    user = UserModel(username, password)
+    try:
+        user = UserModel(username, password)
+    except PasswordsBusy:
+        raise ServiceUnavailable("Too many people are logging in, please try again.")
 
     db = request_session()
     db.add(user)
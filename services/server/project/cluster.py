@@ -0,0 +1,333 @@
+#
+# Running the server as several processes.
+#
+# Every room is owned by a single node, chosen by consistent hashing of the room name over the configured nodes,
+# and only that node keeps the board of the room. Clients can connect to any node: game events are forwarded to the
+# owner of the room through a pub/sub broker, and socket.io uses the same broker to deliver emits to clients which
+# are connected to another node.
+#
+# On the owning node, the events of a room run one at a time in the order they arrived, see project.actors.
+# Events dispatched while handling a socket event carry the session id of its client, so the client can be told when
+# the room is too busy to take its event.
+# Changes which concern every node, such as a user whose cached rating is outdated, are broadcast to all of them.
+#
+# The broker is either Redis (redis://, requires the redis package) or, for development and tests,
+# a small pub/sub server on a UNIX socket (local:///path/to/socket) which is started by the first node using it.
+#
+import bisect
+import hashlib
+import os
+import pickle
+import socket
+import struct
+
+import gevent
+from flask import has_request_context, request
+from gevent.lock import Semaphore
+from gevent.server import StreamServer
+from socketio import PubSubManager
+
+from project.actors import RoomActors
+
+# Points on the ring per node, more points spread the rooms more evenly.
+RING_REPLICAS = 64
+
+SOCKETIO_CHANNEL = "flask-socketio"
+BROADCAST_CHANNEL = "thehive-all"
+
+_FRAME_LENGTH = struct.Struct("!I")
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        points = sorted((_hash("%s#%d" % (node, replica)), node) for node in nodes for replica in range(replicas))
+        self._keys = [key for key, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key: str) -> str:
+        """
+        The node a key belongs to, the first point on the ring at or after the hash of the key.
+
+        :param key:
+        :return:
+        """
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+def _send_frame(connection, lock, message):
+    data = pickle.dumps(message)
+    with lock:
+        connection.sendall(_FRAME_LENGTH.pack(len(data)) + data)
+
+
+def _receive_exactly(connection, size):
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def _receive_frame(connection):
+    size, = _FRAME_LENGTH.unpack(_receive_exactly(connection, _FRAME_LENGTH.size))
+    return pickle.loads(_receive_exactly(connection, size))
+
+
+class LocalBrokerServer:
+    """
+    Pub/sub server on a UNIX socket. Clients send ("subscribe", channel) and ("publish", channel, message) frames,
+    and receive (channel, message) frames for the channels they subscribed to.
+    """
+
+    def __init__(self, path):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(64)
+
+        self._subscribers = {}
+        self._server = StreamServer(listener, self._handle)
+
+    def start(self):
+        self._server.start()
+
+    def _handle(self, connection, address):
+        lock = Semaphore()
+        channels = []
+        try:
+            while True:
+                frame = _receive_frame(connection)
+                if frame[0] == "subscribe":
+                    channels.append(frame[1])
+                    self._subscribers.setdefault(frame[1], {})[connection] = lock
+                elif frame[0] == "publish":
+                    _, channel, message = frame
+                    for subscriber, subscriber_lock in list(self._subscribers.get(channel, {}).items()):
+                        try:
+                            _send_frame(subscriber, subscriber_lock, (channel, message))
+                        except OSError:
+                            pass
+        except (EOFError, OSError):
+            pass
+        finally:
+            for channel in channels:
+                self._subscribers.get(channel, {}).pop(connection, None)
+
+
+class LocalBroker:
+    def __init__(self, path):
+        self.path = path
+        self._server = None
+        self._lock = Semaphore()
+        self._connection = self._connect()
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+            return connection
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+
+        # Nobody is serving the socket yet, so this node becomes the broker.
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._server = LocalBrokerServer(self.path)
+            self._server.start()
+            print("Started the local broker on", self.path)
+        except OSError:
+            # Another node started the broker in the meantime.
+            pass
+
+        connection.connect(self.path)
+        return connection
+
+    def publish(self, channel, message):
+        _send_frame(self._connection, self._lock, ("publish", channel, message))
+
+    def subscribe(self, channel):
+        """
+        Yields the messages published on the channel, forever.
+
+        :param channel:
+        """
+        connection = self._connect()
+        _send_frame(connection, Semaphore(), ("subscribe", channel))
+        while True:
+            _, message = _receive_frame(connection)
+            yield message
+
+
+class RedisBroker:
+    def __init__(self, url):
+        # Only needed when Redis is used.
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def publish(self, channel, message):
+        self._redis.publish(channel, pickle.dumps(message))
+
+    def subscribe(self, channel):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        for item in pubsub.listen():
+            yield pickle.loads(item["data"])
+
+
+class BrokerManager(PubSubManager):
+    """
+    Socket.io client manager sending emits for clients of other nodes through the broker.
+    """
+    name = "broker"
+
+    def __init__(self, broker, channel=SOCKETIO_CHANNEL):
+        super().__init__(channel=channel)
+        self.broker = broker
+
+    def _publish(self, data):
+        self.broker.publish(self.channel, data)
+
+    def _listen(self):
+        yield from self.broker.subscribe(self.channel)
+
+
+class Cluster:
+    def __init__(self):
+        self.node = None
+        self.nodes = ()
+        self.ring = None
+        self.broker = None
+        self.app = None
+        self._handlers = {}
+        self.actors = RoomActors()
+        self.configure("local", ("local",))
+
+    def configure(self, node, nodes, broker=None):
+        """
+        Sets the nodes of the cluster.
+
+        :param node: the name of this node.
+        :param nodes: the names of all nodes, which have to be the same on every node.
+        :param broker: the broker to reach the other nodes with, only needed with more than one node.
+        """
+        if node not in nodes:
+            raise ValueError("Node %s is not one of the nodes %s." % (node, ", ".join(nodes)))
+
+        self.node = node
+        self.nodes = tuple(nodes)
+        self.ring = HashRing(self.nodes)
+        self.broker = broker
+
+    def owner(self, room) -> str:
+        return self.ring.get_node(str(room))
+
+    def owns(self, room) -> bool:
+        return self.owner(room) == self.node
+
+    def handler(self, function):
+        """
+        Registers a function which can be dispatched to the owner of a room, to be used as decorator.
+        """
+        self._handlers[function.__name__] = function
+        return function
+
+    def dispatch(self, room, function, *args):
+        """
+        Queues the function on the node owning the room, behind the events of the room which are still running.
+        The arguments have to be picklable. Within a socket event, the client which sent it is the sender of the
+        queued event, and is told when the room is too busy to take it.
+
+        :param room:
+        :param function: a function registered with handler.
+        :param args:
+        """
+        sender = getattr(request, "sid", None) if has_request_context() else None
+
+        owner = self.owner(room)
+        if owner == self.node:
+            self.actors.submit(room, function, *args, sender=sender)
+        else:
+            self.broker.publish(self._channel(owner), (room, function.__name__, args, sender))
+
+    def broadcast(self, function, *args):
+        """
+        Calls the function on every node, right away on this one. The arguments have to be picklable.
+
+        :param function: a function registered with handler.
+        :param args:
+        """
+        function(*args)
+        if self.broker is not None:
+            self.broker.publish(BROADCAST_CHANNEL, (self.node, function.__name__, args))
+
+    def start(self, app):
+        """
+        Starts handling the functions dispatched or broadcast to this node by others.
+
+        :param app: the app, whose context the functions run in.
+        """
+        self.app = app
+        self.actors.app = app
+        if self.broker is None:
+            return
+
+        gevent.spawn(self._receive)
+        gevent.spawn(self._receive_broadcasts)
+
+    def _channel(self, node):
+        return "thehive-node-%s" % node
+
+    def _receive(self):
+        for room, name, args, sender in self.broker.subscribe(self._channel(self.node)):
+            self.actors.submit(room, self._handlers[name], *args, sender=sender)
+
+    def _receive_broadcasts(self):
+        for node, name, args in self.broker.subscribe(BROADCAST_CHANNEL):
+            # This node already ran it.
+            if node == self.node:
+                continue
+
+            try:
+                with self.app.app_context():
+                    self._handlers[name](*args)
+            except Exception as e:
+                print("%s broadcast by node %s failed: %s" % (name, node, e))
+
+
+cluster = Cluster()
+
+
+def init_cluster(config):
+    """
+    Configures the nodes of the cluster from the [cluster] section of the config.
+    Without that section the server runs as a single node.
+
+    :param config: the parsed config file.
+    :return: the socket.io client manager to use, or None for the default one.
+    """
+    if not config.has_section("cluster"):
+        return None
+
+    section = config["cluster"]
+    url = section["broker"]
+    if url.startswith("local://"):
+        broker = LocalBroker(url[len("local://"):])
+        manager = BrokerManager(broker)
+    elif url.startswith(("redis://", "rediss://")):
+        from socketio import RedisManager
+        broker = RedisBroker(url)
+        manager = RedisManager(url, channel=SOCKETIO_CHANNEL)
+    else:
+        raise ValueError("Unsupported broker %s, use local:// or redis://." % url)
+
+    nodes = [node.strip() for node in section["nodes"].split(",")]
+    cluster.configure(section["node"], nodes, broker)
+    print("Running as node %s of %s." % (cluster.node, ", ".join(cluster.nodes)))
+    return manager
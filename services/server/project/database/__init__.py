@@ -2,9 +2,12 @@ from contextlib import contextmanager
 from typing import Optional
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
+from project.database import pool
+
 OrmModelBase = declarative_base()
 
 _scoped_session = None
@@ -54,12 +57,20 @@ def register_teardown(flask_app):
         _scoped_session.remove()
 
 
-def init_db(connect_string):
+def init_db(connect_string, pool_size=None, max_overflow=None, pool_timeout=None, pool_recycle=None,
+            pool_pre_ping=True, sqlite_synchronous=None):
     """
     Initialise the database with the given connection string.
     :param connect_string: the connection string passed to create_engine,
     in the form of sqlite:///dblocation.db, could be another database engine
-    such as postgres.
+    such as postgres. For MySQL use mysql+mysqlconnector://, that driver is
+    written in Python so waiting on the database lets other greenlets run.
+    :param pool_size: connections kept open.
+    :param max_overflow: connections opened on top of those when all are in use.
+    :param pool_timeout: seconds to wait for a connection before giving up.
+    :param pool_recycle: seconds after which a connection is reopened, before the database closes it.
+    :param pool_pre_ping: whether to test connections before using them, to replace those which were closed.
+    :param sqlite_synchronous: the synchronous pragma for SQLite connections.
     """
 
     global _scoped_session
@@ -67,7 +78,22 @@ def init_db(connect_string):
     global _engine
     global OrmModelBase
 
-    _engine = create_engine(connect_string, echo=False)
+    url = make_url(connect_string)
+    options = {}
+    if not pool.is_memory_sqlite(url):
+        options = {
+            "poolclass": pool.MeasuredQueuePool,
+            "pool_size": pool.DEFAULT_POOL_SIZE if pool_size is None else pool_size,
+            "max_overflow": pool.DEFAULT_MAX_OVERFLOW if max_overflow is None else max_overflow,
+            "pool_timeout": pool.DEFAULT_POOL_TIMEOUT if pool_timeout is None else pool_timeout,
+            "pool_recycle": pool.DEFAULT_POOL_RECYCLE if pool_recycle is None else pool_recycle,
+            "pool_pre_ping": pool_pre_ping,
+        }
+
+    _engine = create_engine(url, echo=False, **options)
+
+    if url.get_backend_name() == "sqlite":
+        pool.configure_sqlite(_engine, sqlite_synchronous or pool.DEFAULT_SQLITE_SYNCHRONOUS)
 
     _session_cls = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
 
@@ -0,0 +1,142 @@
+#
+# Durable storage of the games being played.
+#
+# Every move is appended to a log, and every SNAPSHOT_INTERVAL moves the whole board is stored as well.
+# A takeback is logged like a move, followed by a snapshot, as the moves it takes back may be older than the
+# latest snapshot a game is restored from.
+# Writes are queued on the write-behind queue of project.database.writer, so handlers never wait on the database.
+# On startup the unfinished games are restored from their latest snapshot and the moves made after it. Games without
+# moves for longer than rooms are kept were left by their players, and are marked as finished instead.
+#
+import json
+from datetime import timedelta
+
+from sqlalchemy import func, select
+
+from project.database import session, writer
+from project.database.models import GameModel, GameMoveModel, GameSnapshotModel
+from project.game.Board import Board, BoardSnapshot
+
+# Amount of moves after which the whole board is stored again.
+SNAPSHOT_INTERVAL = 10
+
+# The fields of a placeTile request which describe the move, takeback is set for moves which were taken back.
+_MOVE_FIELDS = ("x", "y", "new_x", "new_y", "image", "takeback")
+
+
+def record_move(game: Board, room: str, username: str, data: dict):
+    """
+    Queues a move which has just been made on the board for storage.
+
+    :param game: the board the move was made on.
+    :param room: the room of the game.
+    :param username: the player who made the move.
+    :param data: the data of the placeTile request, or {"takeback": True} after a takeback.
+    """
+    # Putting a tile back where it was picked up does not change the board.
+    if data.get("x") is not None and (int(data["x"]), int(data["y"])) == (int(data["new_x"]), int(data["new_y"])):
+        return
+
+    epoch = game.epoch
+    sequence = game.sequence
+
+    if sequence == 1:
+        writer.put(lambda db: db.add(GameModel(epoch=epoch, room=room, finished=False)))
+
+    move = json.dumps(dict((key, data[key]) for key in _MOVE_FIELDS if data.get(key) is not None))
+    writer.put(lambda db: db.add(GameMoveModel(game_epoch=epoch, sequence=sequence, player=username, data=move)))
+
+    # The first snapshot also stores the players of the game.
+    if sequence == 1 or sequence % SNAPSHOT_INTERVAL == 0 or data.get("takeback"):
+        snapshot = json.dumps(game.snapshot())
+        writer.put(lambda db: db.add(GameSnapshotModel(game_epoch=epoch, sequence=sequence, data=snapshot)))
+
+
+def finish_game(game: Board):
+    """
+    Queues marking the game as finished, so it is not restored anymore.
+
+    :param game:
+    """
+    if game.sequence == 0:
+        return
+
+    epoch = game.epoch
+
+    def write(db):
+        # The game could still be waiting to be inserted in the same batch.
+        db.flush()
+        db.query(GameModel).filter(GameModel.epoch == epoch).update({"finished": True})
+
+    writer.put(write)
+
+
+def finish_abandoned_games(db, max_idle) -> int:
+    """
+    Marks the unfinished games without moves for max_idle seconds as finished.
+
+    :param db: the database session, which is committed.
+    :param max_idle: seconds.
+    :return: the amount of games marked as finished.
+    """
+    # The times the moves were stored at come from the clock of the database.
+    cutoff = db.execute(select(func.now())).scalar() - timedelta(seconds=max_idle)
+    idle = select(GameMoveModel.game_epoch) \
+        .group_by(GameMoveModel.game_epoch) \
+        .having(func.max(GameMoveModel.created) < cutoff)
+
+    count = db.query(GameModel) \
+        .filter(GameModel.finished.is_(False), GameModel.epoch.in_(idle)) \
+        .update({"finished": True}, synchronize_session=False)
+    db.commit()
+    return count
+
+
+def load_games(max_idle=None) -> dict:
+    """
+    Restores the unfinished games from the database.
+
+    :param max_idle: seconds since the last move after which a game is abandoned and not restored, None to restore
+                     all unfinished games.
+    :return: the restored boards by room.
+    """
+    games = {}
+    with session() as db:
+        if max_idle is not None:
+            abandoned = finish_abandoned_games(db, max_idle)
+            if abandoned:
+                print("Finished %d games which were abandoned for over %d seconds." % (abandoned, max_idle))
+
+        for game in db.query(GameModel).filter(GameModel.finished.is_(False)).order_by(GameModel.created):
+            snapshot = db.query(GameSnapshotModel) \
+                .filter(GameSnapshotModel.game_epoch == game.epoch) \
+                .order_by(GameSnapshotModel.sequence.desc()) \
+                .first()
+            if snapshot is None:
+                continue
+
+            board = Board.from_snapshot(BoardSnapshot(*json.loads(snapshot.data)))
+            board.epoch = game.epoch
+            board.sequence = snapshot.sequence
+
+            moves = db.query(GameMoveModel) \
+                .filter(GameMoveModel.game_epoch == game.epoch, GameMoveModel.sequence > snapshot.sequence) \
+                .order_by(GameMoveModel.sequence)
+            for move in moves:
+                player = board.get_player(move.player)
+                data = json.loads(move.data)
+                if data.get("takeback"):
+                    # Only replayed when the snapshot stored after the takeback is missing.
+                    valid = board.takeback() is not None
+                else:
+                    valid = player is not None and board.move(player, data)
+
+                if not valid:
+                    print("Could not replay move %d of game %s." % (move.sequence, game.epoch))
+                    break
+
+            # Later games in the same room replace earlier ones.
+            games[game.room] = board
+
+    return games
+
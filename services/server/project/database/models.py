@@ -1,8 +1,8 @@
-import bcrypt as bcrypt
-from sqlalchemy import Column, Integer, LargeBinary, String, Float
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Integer, LargeBinary, String, Text, func
 from sqlalchemy.orm import deferred
 
 from project.database import OrmModelBase
+from project.passwords import passwords
 
 
 class UserModel(OrmModelBase):
@@ -22,10 +22,10 @@ class UserModel(OrmModelBase):
     def __init__(self, name: str, password: str = None):
         self.name = name
         if password is not None:
-            self.password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+            self.password = passwords.hash(password)
 
     def check_password(self, password):
-        return bcrypt.checkpw(password.encode(), self.password)
+        return passwords.check(password, self.password)
 
     def to_json(self):
         return {
@@ -33,3 +33,50 @@ class UserModel(OrmModelBase):
             "name": self.name,
             "elo": self.elo
         }
+
+
+class GameModel(OrmModelBase):
+    """
+    A game played in a room, identified by the epoch of its board.
+    """
+
+    __tablename__ = 'games'
+
+    epoch = Column(String(32), primary_key=True)
+    room = Column(String(), nullable=False, index=True)
+    created = Column(DateTime(), nullable=False, server_default=func.now())
+    finished = Column(Boolean(), nullable=False, default=False, index=True)
+
+
+class GameMoveModel(OrmModelBase):
+    """
+    A move of a game, the moves of a game are only ever appended.
+    """
+
+    __tablename__ = 'game_moves'
+
+    id = Column(Integer(), primary_key=True, autoincrement=True)
+    game_epoch = Column(String(32), ForeignKey('games.epoch'), nullable=False, index=True)
+
+    # The sequence number of the board after the move.
+    sequence = Column(Integer(), nullable=False)
+    player = Column(String(), nullable=False)
+    # The data of the placeTile request as JSON.
+    data = Column(Text(), nullable=False)
+    # When the move was stored, the last move of a game tells when it was played.
+    created = Column(DateTime(), nullable=False, server_default=func.now())
+
+
+class GameSnapshotModel(OrmModelBase):
+    """
+    The whole board of a game after a move, so the game can be restored without replaying all of its moves.
+    """
+
+    __tablename__ = 'game_snapshots'
+
+    id = Column(Integer(), primary_key=True, autoincrement=True)
+    game_epoch = Column(String(32), ForeignKey('games.epoch'), nullable=False, index=True)
+
+    sequence = Column(Integer(), nullable=False)
+    # A BoardSnapshot as JSON.
+    data = Column(Text(), nullable=False)
@@ -0,0 +1,111 @@
+#
+# Connection pooling for the database engine.
+#
+# With gevent, a greenlet waiting for a pooled connection lets the other greenlets run, but the time spent waiting
+# still adds to the latency of the request or socket event. The pool measures how long checkouts wait and how many
+# connections are in use, and reports it every REPORT_INTERVAL seconds while the database is being used.
+#
+# SQLite connections are switched to write-ahead logging, so readers no longer block on the writer and the other
+# way around, and wait for a locked database instead of failing right away.
+#
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_POOL_RECYCLE = 3600
+DEFAULT_SQLITE_SYNCHRONOUS = "NORMAL"
+
+SQLITE_SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# Milliseconds SQLite waits for a lock held by another connection.
+SQLITE_BUSY_TIMEOUT = 5000
+
+# Seconds between two reports of the pool usage.
+REPORT_INTERVAL = 60
+
+
+class PoolMetrics:
+    def __init__(self):
+        self._reported = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        # Seconds spent waiting for a connection, in total and the longest single wait.
+        self.waited = 0.0
+        self.longest_wait = 0.0
+        # The most connections in use at the same time.
+        self.peak_in_use = 0
+
+    def record(self, waited, in_use):
+        self.checkouts += 1
+        self.waited += waited
+        self.longest_wait = max(self.longest_wait, waited)
+        self.peak_in_use = max(self.peak_in_use, in_use)
+
+    def report(self, pool):
+        now = time.monotonic()
+        if now - self._reported < REPORT_INTERVAL:
+            return
+
+        average = self.waited / self.checkouts if self.checkouts else 0
+        print("Database pool: %d checkouts waited %.1f ms on average and %.1f ms at most, %d timed out, "
+              "%d connections in use at most and %d now, with a pool size of %d."
+              % (self.checkouts, average * 1000, self.longest_wait * 1000, self.timeouts,
+                 self.peak_in_use, pool.checkedout(), pool.size()))
+
+        self._reported = now
+        self.reset()
+
+
+metrics = PoolMetrics()
+
+
+class MeasuredQueuePool(QueuePool):
+    """
+    A QueuePool which records the time spent waiting for connections in metrics.
+    """
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            metrics.timeouts += 1
+            raise
+
+        metrics.record(time.monotonic() - start, self.checkedout())
+        metrics.report(self)
+        return connection
+
+
+def is_memory_sqlite(url) -> bool:
+    # An in-memory database only exists within its connection, so it cannot be pooled.
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def configure_sqlite(engine, synchronous=DEFAULT_SQLITE_SYNCHRONOUS):
+    """
+    Sets the pragmas of every new connection of an SQLite engine.
+
+    :param engine:
+    :param synchronous: how often SQLite waits for writes to reach the disk, NORMAL is safe with write-ahead logging.
+    """
+    synchronous = synchronous.upper()
+    if synchronous not in SQLITE_SYNCHRONOUS_MODES:
+        raise ValueError("Unsupported synchronous mode %s, use one of %s."
+                         % (synchronous, ", ".join(SQLITE_SYNCHRONOUS_MODES)))
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(connection, record):
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=%s" % synchronous)
+        cursor.execute("PRAGMA busy_timeout=%d" % SQLITE_BUSY_TIMEOUT)
+        cursor.close()
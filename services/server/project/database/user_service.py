@@ -1,7 +1,19 @@
+import time
+from collections import OrderedDict
 from typing import Optional
 
-from project.database import request_session
+from project.cluster import cluster
+from project.database import request_session, writer
 from project.database.models import UserModel
+from project.game.Player import DetachedUser
+
+# Most users kept in the cache, and seconds after which a cached user is read from the database again.
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
+# Results of games of which the ratings still have to be stored, in the order they were played, or None if there are
+# none. These are stored by a single write on the write-behind queue.
+_results = None
 
 
 def get_user(uid=None, name=None) -> Optional[UserModel]:
@@ -26,22 +38,138 @@ def get_user(uid=None, name=None) -> Optional[UserModel]:
     return sub.one_or_none()
 
 
+class UserCache:
+    """
+    Users by id and by name, least recently used first. Users are kept as DetachedUser, as database rows cannot be
+    used outside the session they were loaded in.
+    """
+
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._ids = {}
+
+    def get(self, uid=None, name=None) -> Optional[DetachedUser]:
+        if uid is None:
+            uid = self._ids.get(name)
+
+        entry = self._users.get(uid)
+        if entry is None:
+            return None
+
+        user, expires = entry
+        if expires < time.monotonic():
+            self.invalidate(uid=uid)
+            return None
+
+        self._users.move_to_end(uid)
+        return user
+
+    def put(self, user: UserModel) -> DetachedUser:
+        self.invalidate(uid=user.id)
+
+        detached = DetachedUser(user.name, user.elo, user.id)
+        self._users[user.id] = (detached, time.monotonic() + self.ttl)
+        self._ids[user.name] = user.id
+
+        while len(self._users) > self.size:
+            _, (oldest, _) = self._users.popitem(last=False)
+            self._ids.pop(oldest.name, None)
+        return detached
+
+    def invalidate(self, uid=None, name=None):
+        if uid is None:
+            uid = self._ids.get(name)
+
+        entry = self._users.pop(uid, None)
+        if entry is not None:
+            self._ids.pop(entry[0].name, None)
+
+    def clear(self):
+        self._users.clear()
+        self._ids.clear()
+
+
+user_cache = UserCache()
+
+
+def get_cached_user(uid=None, name=None) -> Optional[DetachedUser]:
+    """
+    Finds a user like get_user, but only goes to the database if the user is not cached.
+    The user is a copy without a password, which is not updated when the user changes until it is invalidated.
+
+    :param uid:
+    :param name:
+    :return:
+    """
+    user = user_cache.get(uid=uid, name=name)
+    if user is None:
+        user = get_user(uid=uid, name=name)
+        if user is not None:
+            user = user_cache.put(user)
+    return user
+
+
 def expect_result(p1, p2):
     exp = (p2 - p1) / 400.0
     return 1 / ((10.0 ** exp) + 1)
 
 
-def award_elo(winner_name: str, loser_name: str):
-    db = request_session()
+def award_elo(winner_name: str, loser_name: str, draw=False, committed=None):
+    """
+    Queues updating the ratings of both players after a game, and returns before the ratings are stored.
+    Results are applied in the order they were queued, the results queued together are stored in a single write.
+
+    :param winner_name:
+    :param loser_name:
+    :param draw: whether the game was a draw, in which case the order of the players does not matter.
+    :param committed: called without arguments once the new ratings are stored.
+    :return:
+    """
+    global _results
+
+    if _results is None:
+        results = _results = []
+        writer.put(lambda db: _store_results(db, results), lambda: _results_stored(results))
+    _results.append((winner_name, loser_name, draw, committed))
+
+
+def _store_results(db, results):
+    global _results
+
+    # Later results go to the next write, this one could be retried.
+    if results is _results:
+        _results = None
+
+    names = set(name for winner, loser, _, _ in results for name in (winner, loser))
+    users = dict((user.name, user) for user in db.query(UserModel).filter(UserModel.name.in_(names)))
+
+    for winner_name, loser_name, draw, _ in results:
+        winner = users.get(winner_name)
+        loser = users.get(loser_name)
+        if winner is None or loser is None:
+            print("Could not rate the game of %s and %s, a player does not exist." % (winner_name, loser_name))
+            continue
+
+        result = expect_result(winner.elo, loser.elo)
+        score = 0.5 if draw else 1
+
+        winner.elo = winner.elo + 20 * (score - result)
+        loser.elo = loser.elo - 20 * (score - result)
 
-    winner = get_user(name=winner_name)
-    loser = get_user(name=loser_name)
 
-    result = expect_result(winner.elo, loser.elo)
+@cluster.handler
+def invalidate_users(names):
+    for name in names:
+        user_cache.invalidate(name=name)
 
-    winner.elo = winner.elo + 20 * (1 - result)
-    loser.elo = loser.elo - 20 * (1 - result)
 
-    # Update the values.
-    db.commit()
+def _results_stored(results):
+    # Other nodes could have cached the players as well.
+    names = set(name for winner, loser, _, _ in results for name in (winner, loser))
+    cluster.broadcast(invalidate_users, sorted(names))
 
+    for _, _, _, committed in results:
+        if committed is not None:
+            committed()
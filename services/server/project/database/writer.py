@@ -0,0 +1,115 @@
+#
+# Write-behind queue for the database.
+#
+# Handlers queue writes, functions applying a change to a database session, and return right away. A background
+# greenlet commits the queued writes in batches, in the order they were queued, so writes about the same user or
+# game never overtake each other. A batch which fails to commit is retried with a growing delay before any later
+# writes are committed. After the last attempt every write of the batch is committed on its own, so a single broken
+# write does not lose the others.
+#
+import atexit
+
+import gevent
+from gevent.queue import Empty, Queue
+
+from project.database import session
+
+# Seconds the writer waits for more writes before committing, and the most writes committed at once.
+FLUSH_INTERVAL = 0.5
+BATCH_SIZE = 500
+
+# Attempts at committing a batch, and seconds before the first retry, doubling for every next one.
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 0.5
+
+# Writes as pairs of the function applying it and the function to call once it is committed, if any.
+_writes = Queue()
+_writer = None
+
+
+def put(write, committed=None):
+    """
+    Queues a write to be committed in the background, after all writes queued before it.
+    The write can be called more than once, when committing its batch is retried.
+
+    :param write: called with a database session to apply the change, without committing it.
+    :param committed: called without arguments after the write has been committed.
+    """
+    _writes.put((write, committed))
+
+
+def _commit(writes) -> bool:
+    try:
+        with session() as db:
+            for write, _ in writes:
+                write(db)
+            db.commit()
+    except Exception as e:
+        print("Storing %d writes failed: %s" % (len(writes), e))
+        return False
+
+    for _, committed in writes:
+        if committed is None:
+            continue
+        try:
+            committed()
+        except Exception as e:
+            print("Handling a stored write failed: %s" % e)
+    return True
+
+
+def _commit_with_retry(writes, delay=gevent.sleep):
+    for attempt in range(MAX_ATTEMPTS):
+        if _commit(writes):
+            return
+        if attempt + 1 < MAX_ATTEMPTS:
+            delay(RETRY_DELAY * 2 ** attempt)
+
+    if len(writes) == 1:
+        print("Dropped a write after %d attempts." % MAX_ATTEMPTS)
+        return
+
+    # Find the writes which cannot be stored, and keep the others.
+    dropped = sum(not _commit([write]) for write in writes)
+    print("Dropped %d of %d writes after %d attempts." % (dropped, len(writes), MAX_ATTEMPTS))
+
+
+def _take_writes(writes):
+    while len(writes) < BATCH_SIZE:
+        try:
+            writes.append(_writes.get_nowait())
+        except Empty:
+            break
+    return writes
+
+
+def _write_loop():
+    while True:
+        # Writes stay queued until they are committed, so flush can still commit them when the server exits.
+        _writes.peek()
+        # Give other writes the chance to arrive, so they are committed together.
+        gevent.sleep(FLUSH_INTERVAL)
+        _commit_with_retry(_take_writes([]))
+
+
+def pending() -> int:
+    return _writes.qsize()
+
+
+def flush():
+    """
+    Commits all queued writes right away, without waiting between retries.
+    """
+    while not _writes.empty():
+        _commit_with_retry(_take_writes([]), delay=lambda seconds: None)
+
+
+def start_writer():
+    """
+    Starts committing the queued writes in the background, remaining writes are committed when the server exits.
+    """
+    global _writer
+
+    if _writer is None:
+        _writer = gevent.spawn(_write_loop)
+        atexit.register(flush)
@@ -1,20 +1,30 @@
 import json
-from typing import Optional
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, NamedTuple, Optional
 
-from project.database.models import UserModel
-from project.game.Player import Player
+from project.game.Player import DetachedUser, Player
+from project.game.encoding import encode_player
+from project.game.grid import CELLS, HALF, MAX_COORDINATE, NEIGHBOURS, cell_id, relative_xy
+from project.game.zobrist import piece_key
 
+if TYPE_CHECKING:
+    from project.database.models import UserModel
 
-class Directions:
-    TOP_LEFT = 0
-    TOP_RIGHT = 1
-    BOTTOM_LEFT = 2
-    BOTTOM_RIGHT = 3
-    LEFT = 4
-    RIGHT = 5
+# Maximum amount of positions and pieces for which the valid moves are remembered.
+MOVE_CACHE_SIZE = 256
+
+# Maximum amount of moves kept to bring clients up to date, clients further behind receive the whole board.
+DELTA_LOG_SIZE = 64
+
+# Cell arrays of an empty board, shared by all boards until their first tile is placed.
+_EMPTY_CELLS = bytes(CELLS)
 
 
 class Tile:
+    __slots__ = ("x", "y", "original_x", "original_y", "z", "owner", "type")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -25,7 +35,7 @@ class Tile:
         self.type = "unknown"
 
     def __repr__(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(dict((key, getattr(self, key)) for key in self.__slots__))
 
     def __eq__(self, other):
         return self.x == other.x and self.y == other.y and self.owner == other.owner and self.type == other.type and self.z == other.z
@@ -36,9 +46,18 @@ class Tile:
     def __hash__(self):
         return hash((self.x, self.y, self.owner, self.type))
 
+    def moved_to(self, x, y):
+        """
+        Tiles on the board are shared by clones of the board and never change, so moving creates a new tile.
 
-def positive_mod(y, mod):
-    return ((y % mod) + mod) % mod
+        :param x:
+        :param y:
+        :return: the same piece on (x, y).
+        """
+        tile = Tile(x, y)
+        tile.owner = self.owner
+        tile.type = self.type
+        return tile
 
 
 def is_in_list(new_tile, tiles):
@@ -48,91 +67,23 @@ def is_in_list(new_tile, tiles):
     return False
 
 
-def _make_bottom_right(tile):
-    if tile.y % 2 == 0:
-        return Tile(tile.x, tile.y + 1)
-    else:
-        return Tile(tile.x + 1, tile.y + 1)
-
-
-def _make_bottom_left(tile):
-    if tile.y % 2 == 0:
-        return Tile(tile.x - 1, tile.y + 1)
-    else:
-        return Tile(tile.x, tile.y + 1)
-
-
-def _make_top_right(tile):
-    if tile.y % 2 == 0:
-        return Tile(tile.x, tile.y - 1)
-    else:
-        return Tile(tile.x + 1, tile.y - 1)
-
-
-def _make_top_left(tile):
-    if tile.y % 2 == 0:
-        return Tile(tile.x - 1, tile.y - 1)
-    else:
-        return Tile(tile.x, tile.y - 1)
-
-
-def _make_tiles_around(tile: Tile):
-    bump = positive_mod(tile.y, 2) * 2 - 1
-
-    tiles = [
-        # Add top and bottom
-        Tile(tile.x, tile.y - 1),
-        Tile(tile.x, tile.y + 1),
-        # Add left and right
-        Tile(tile.x - 1, tile.y),
-        Tile(tile.x + 1, tile.y),
-        # Add the other two up and down tiles
-        Tile(tile.x + bump, tile.y - 1),
-        Tile(tile.x + bump, tile.y + 1)
-    ]
-
-    return tiles
-
-
-def get_direction(position, tile):
-    if position.y == tile.y and position.x == tile.x - 1:
-        return Directions.LEFT
-    if position.y == tile.y and position.x == tile.x + 1:
-        return Directions.RIGHT
-    if (position.y % 2 == 0 and position.x - 1 == tile.x and position.y - 1 == tile.y) \
-            or (position.x == tile.x and position.y - 1 == tile.y):
-        return Directions.TOP_LEFT
-    if (position.y % 2 == 0 and position.x == tile.x and position.y - 1 == tile.y) \
-            or (position.x + 1 == tile.x and position.y - 1 == tile.y):
-        return Directions.TOP_RIGHT
-    if (position.y % 2 == 0 and position.x - 1 == tile.x and position.y + 1 == tile.y) \
-            or (position.x == tile.x and position.y + 1 == tile.y):
-        return Directions.BOTTOM_LEFT
-    if (position.y % 2 == 0 and position.x == tile.x and position.y + 1 == tile.y) \
-            or (position.x + 1 == tile.x and position.y + 1 == tile.y):
-        return Directions.BOTTOM_RIGHT
-
-
-def slow_get_direction(position, tile):
-    if _make_top_left(position) == tile:
-        return Directions.TOP_LEFT
-    if _make_top_right(position) == tile:
-        return Directions.TOP_RIGHT
-    if _make_bottom_left(position) == tile:
-        return Directions.BOTTOM_LEFT
-    if _make_bottom_right(position) == tile:
-        return Directions.BOTTOM_RIGHT
-    if position.y == tile.y and position.x == tile.x - 1:
-        return Directions.LEFT
-    if position.y == tile.y and position.x == tile.x + 1:
-        return Directions.RIGHT
-    return None
-
+class BoardSnapshot(NamedTuple):
+    """
+    Compact copy of a game made of plain tuples, so it can be pickled and sent to worker processes.
+    """
+    # (x, y, ((type, owner) for every tile from bottom to top)) for every occupied cell.
+    stacks: tuple
+    # Owners in the order they are numbered in the hash.
+    sides: tuple
+    # (name, elo, ((piece, amount), ...), turn) for every player.
+    players: tuple
+    turn: int
+    turn_number: int
+    hash: int
 
 
 class Board:
     def __init__(self):
-        self.tiles = {}
         self.players = []
         self.spectators = []
         self.max_players = 2
@@ -140,8 +91,60 @@ class Board:
         self.turn_number = 0
         self.winner = None
         self.loser = None
+        # Whether the game ended with both queens surrounded at once, in which case there is no winner.
+        self.draw = False
+        self._clear()
+
+    def _clear(self):
+        # Whether the state below is shared with a clone, and has to be copied before it is changed.
+        # Empty boards share the empty cell arrays, so rooms without tiles do not allocate them.
+        self._shared = True
+
+        # Every piece on the board gets a small integer code, 0 means the cell is empty.
+        self._pieces = [None]
+        self._free_codes = []
+
+        # Flat array indexed by cell id, holding the code of the top piece. The height of a stack is the z of its top.
+        self._top = _EMPTY_CELLS
+
+        # Codes of the pieces covered by a beetle or mosquito, from bottom to top.
+        self._below = {}
+        self._occupied = set()
+
+        # Amount of occupied neighbours of every cell, and the cells with at least one, which are the cells in and
+        # around the hive. Both are updated whenever a cell becomes occupied or empty.
+        self._neighbours = _EMPTY_CELLS
+        self._hive = set()
+
+        # The queen of every player on the board, by owner, also when covered.
+        self._queens = {}
 
-    def add_player(self, user: UserModel):
+        # Coordinates of the last placed piece, used to translate cell ids back into coordinates.
+        self._anchor = (0, 0)
+
+        # Cells whose piece cannot be picked up without breaking the hive, rebuilt on demand after each change.
+        self._pinned = None
+
+        # Zobrist hash of the position, updated on every put_tile and remove_tile.
+        self.hash = 0
+        self._sides = {}
+
+        # Least recently used cache of (hash, origin cell or None, side) to the cells the piece can move to.
+        self._move_cache = OrderedDict()
+
+        # Undo records of the moves made with move(), oldest first, so they can be taken back.
+        self._history = []
+
+        # Every game gets a new epoch, within which each move increments the sequence number.
+        self.epoch = uuid.uuid4().hex
+        self.sequence = 0
+        self._deltas = deque(maxlen=DELTA_LOG_SIZE)
+
+        # Encoded payloads of the board at (epoch, sequence), shared by every client requesting them.
+        self._payload_version = None
+        self._payloads = {}
+
+    def add_player(self, user: "UserModel"):
         if len(self.players) < self.max_players:
             self.players.append(Player(self, user))
             return "player"
@@ -162,27 +165,130 @@ class Board:
         self.turn = (self.turn + 1) % len(self.players)
         self.turn_number += 1
 
+    @property
+    def tiles(self) -> dict:
+        """
+        All tiles on the board as {y: {x: [tiles from bottom to top]}}, built on demand for serialisation.
+
+        :return:
+        """
+        tiles = {}
+        for cell in self._occupied:
+            stack = [self._pieces[code] for code in self._below.get(cell, ())]
+            top = self._pieces[self._top[cell]]
+            stack.append(top)
+            tiles.setdefault(top.y, {})[top.x] = stack
+
+        return tiles
+
+    def _xy(self, cell):
+        return relative_xy(cell, *self._anchor)
+
+    def get_coordinates(self, cell):
+        """
+        Translates a cell id in or around the hive back into its (x, y) coordinates.
+
+        :param cell:
+        :return:
+        """
+        return self._xy(cell)
+
+    def _make_tiles(self, cells) -> set:
+        result = set()
+        for cell in self._in_range(cells):
+            result.add(Tile(*self._xy(cell)))
+        return result
+
+    def _in_range(self, cells):
+        """
+        Leaves out the cells beyond MAX_COORDINATE, where no tile can be placed or moved to.
+
+        :param cells: cell ids in or around the hive.
+        :return: the cells themselves when the hive is too far from the limit to reach it.
+        """
+        # Every cell in and around the hive is less than HALF away from the anchor.
+        x, y = self._anchor
+        if max(abs(x), abs(y)) + HALF <= MAX_COORDINATE:
+            return cells
+
+        result = []
+        for cell in cells:
+            x, y = self._xy(cell)
+            if abs(x) <= MAX_COORDINATE and abs(y) <= MAX_COORDINATE:
+                result.append(cell)
+        return result
+
+    def _push(self, cell, code):
+        if self._shared:
+            self._unshare()
+
+        top = self._top[cell]
+        if top:
+            self._below.setdefault(cell, []).append(top)
+        else:
+            self._occupied.add(cell)
+            self._count_neighbours(cell, 1)
+        self._top[cell] = code
+
+    def _pop(self, cell):
+        if self._shared:
+            self._unshare()
+
+        code = self._top[cell]
+        below = self._below.get(cell)
+        if below:
+            self._top[cell] = below.pop()
+            if not below:
+                del self._below[cell]
+        else:
+            self._top[cell] = 0
+            self._occupied.discard(cell)
+            self._count_neighbours(cell, -1)
+        return code
+
+    def _count_neighbours(self, cell, change):
+        neighbours = self._neighbours
+        hive = self._hive
+        for around in NEIGHBOURS[cell]:
+            count = neighbours[around] + change
+            neighbours[around] = count
+            if count == 0:
+                hive.discard(around)
+            elif count == change:
+                hive.add(around)
+
+    def _get_height(self, cell) -> int:
+        code = self._top[cell]
+        return self._pieces[code].z + 1 if code else 0
+
     def get_hive_tiles(self, exclude=None) -> set:
         """
         Returns all valid squares around, and in the hive
 
         :return:
         """
-        hive_tiles = set()
-        for y, row in self.tiles.items():
-            for x, l in row.items():
-                # row.items() is a list of all tiles on a single square, while get_tile returns the highest one.
-                tile = self.get_tile(x, y)
+        skip = None
+        if exclude is not None:
+            cell = cell_id(exclude.x, exclude.y)
+            # Only skip the excluded tile if there is no tile underneath.
+            if self._get_height(cell) == 1:
+                skip = cell
 
-                # Skip this entry if the coordinates are the same, and if there is no tile underneath.
-                if exclude is not None and x == exclude.x and y == exclude.y and len(l) == 1:
-                    continue
-                if tile is None:
-                    continue
-                around = set(_make_tiles_around(tile))
-                hive_tiles = hive_tiles.union(around)
+        return self._make_tiles(self._get_hive_cells(skip))
+
+    def _get_hive_cells(self, skip=None) -> set:
+        """
+        The cells next to at least one occupied cell.
 
-        return hive_tiles
+        :param skip: cell id of a piece to leave out, as if it was picked up.
+        :return: without skip this is the set kept up to date by the board, which must not be changed.
+        """
+        if skip is None:
+            return self._hive
+
+        # Without the piece, cells which only touched it are no longer next to the hive.
+        neighbours = self._neighbours
+        return self._hive.difference(cell for cell in NEIGHBOURS[skip] if neighbours[cell] == 1)
 
     def is_move_valid(self, original_tile: Optional[Tile], new_tile: Tile, user: Player):
         """
@@ -199,258 +305,290 @@ class Board:
         elif self.turn_number == 1:
             # In turn two, the first tile must have been placed already.
             tile = self._get_random_tile()
-            return is_in_list(new_tile, _make_tiles_around(tile))
+            return is_in_list(new_tile, self._make_tiles(NEIGHBOURS[cell_id(tile.x, tile.y)]))
 
         moves = self.get_valid_moves(original_tile, user)
         return is_in_list(new_tile, moves)
 
     def _get_random_tile(self):
-        for row in self.tiles.values():
-            for col in row.values():
-                if len(col) > 0:
-                    return col[len(col) - 1]
+        for cell in self._occupied:
+            return self._pieces[self._top[cell]]
         return None
 
-    def _get_top_left(self, tile):
-        if tile.y % 2 == 0:
-            return self.get_tile(tile.x - 1, tile.y - 1)
-        else:
-            return self.get_tile(tile.x, tile.y - 1)
+    def get_valid_moves(self, original_tile, user: Player):
+        origin = None
+        if original_tile is not None:
+            origin = cell_id(original_tile.x, original_tile.y)
 
-    def _get_top_right(self, tile):
-        if tile.y % 2 == 0:
-            return self.get_tile(tile.x, tile.y - 1)
-        else:
-            return self.get_tile(tile.x + 1, tile.y - 1)
+        return self._make_tiles(self.get_valid_cells(origin, user.user.name))
 
-    def _get_bottom_left(self, tile):
-        if tile.y % 2 == 0:
-            return self.get_tile(tile.x - 1, tile.y + 1)
-        else:
-            return self.get_tile(tile.x, tile.y + 1)
+    def get_valid_cells(self, origin, owner) -> frozenset:
+        """
+        Returns the cell ids the tile on the origin cell can move to, or where the owner can place a new tile if
+        the origin is None.
 
-    def _get_bottom_right(self, tile):
-        if tile.y % 2 == 0:
-            return self.get_tile(tile.x, tile.y + 1)
+        :param origin: cell id of the tile to move, or None.
+        :param owner: name of the player.
+        :return:
+        """
+        # The moves of a piece only depend on the position, so they can be reused until the position changes.
+        key = (self.hash, origin, self._get_side(owner) if origin is None else None)
+        cells = self._move_cache.get(key)
+        if cells is None:
+            cells = self._find_valid_cells(origin, owner)
+            self._move_cache[key] = cells
+            if len(self._move_cache) > MOVE_CACHE_SIZE:
+                self._move_cache.popitem(last=False)
         else:
-            return self.get_tile(tile.x + 1, tile.y + 1)
+            self._move_cache.move_to_end(key)
 
-    def get_valid_moves(self, original_tile, user: Player):
-        valid_moves = self.get_hive_tiles(original_tile)
+        return cells
 
+    def _find_valid_cells(self, origin, owner) -> frozenset:
         # Newly placed tile on the board
-        if original_tile is None:
-            valid_moves = self.get_allied_squares(valid_moves, user)
+        if origin is None:
+            return frozenset(self._in_range(self._get_placement_cells(owner)))
 
         # Move a tile from the original tile location to the new tile location.
-        else:
-            # Remove the current tile so it will not be taken into account.
-            excluded = self.tiles[original_tile.y][original_tile.x].pop()
-
-            if original_tile.type == "ant":
-                valid_moves = self._get_valid_ant_moves(original_tile, valid_moves)
-            elif original_tile.type == "grasshopper":
-                valid_moves = self._get_valid_grasshopper_moves(original_tile)
-            elif original_tile.type == "queen":
-                valid_moves = self._get_valid_queen_moves(original_tile, subset=valid_moves)
-            elif original_tile.type == "beetle":
-                valid_moves = self._get_valid_beetle_moves(original_tile, subset=valid_moves)
-            elif original_tile.type == "spider":
-                valid_moves = self._get_valid_spider_moves(original_tile, subset=valid_moves)
-            elif original_tile.type == "mosquito":
-                valid_moves = self._get_valid_mosquito_moves(original_tile, subset=valid_moves)
-            elif original_tile.type == "ladybug":
-                valid_moves = self._get_valid_ladybug_moves(original_tile, subset=valid_moves)
-
-            self.put_tile(excluded)
-
-            actual = Tile(original_tile.x, original_tile.y)
-            if actual in valid_moves:
-                valid_moves.remove(actual)
-        return valid_moves
+        # Remove the current tile so it will not be taken into account, which also takes it out of the hive cells.
+        excluded = self._pop(origin)
+        try:
+            cells = self._get_piece_moves(self._pieces[excluded].type, origin, self._hive)
+        finally:
+            self._push(origin, excluded)
 
-    def get_allied_squares(self, subset: set, player: Player) -> set:
-        result = set()
+        cells.discard(origin)
+        return frozenset(self._in_range(cells))
 
-        for entry in subset:
-            selection = self.get_tile(entry.x, entry.y)
+    @contextmanager
+    def lifted(self, cell):
+        """
+        Takes the top tile of a cell off the board for the duration of a with block, leaving the board as it is while
+        that tile is being moved. The tile is put back afterwards, also after an exception.
 
-            # Allied squares must be empty, as you cannot initially place tiles on top of another.
-            if selection is not None:
-                continue
+        :param cell: cell id of the tile.
+        :return: the lifted tile.
+        """
+        code = self._pop(cell)
+        try:
+            yield self._pieces[code]
+        finally:
+            self._push(cell, code)
 
-            selection = Tile(entry.x, entry.y)
+    def get_piece_moves(self, piece, origin) -> set:
+        """
+        The cells a piece can move to following only its own rules, while it is lifted from the origin.
 
-            surroundings = set(_make_tiles_around(selection))
-            valid = True
-            for surrounding in surroundings:
-                tile = self.get_tile(surrounding.x, surrounding.y)
-                if tile is not None and tile.owner != player.user.name:
-                    valid = False
-                    break
+        :param piece: the type of the tile.
+        :param origin: cell id the tile was lifted from.
+        :return:
+        """
+        return self._get_piece_moves(piece, origin, self._hive)
 
-            if valid:
-                result.add(selection)
+    def clear_caches(self):
+        """
+        Forgets the moves and pinned cells remembered for the position, so they are computed again on the next request.
+        """
+        self._move_cache.clear()
+        self._pinned = None
 
-        return result
+    def get_legal_moves(self, player: Player) -> list:
+        """
+        All legal moves of the player, as (piece, origin cell or None, target cell) tuples.
+        This covers placing every piece the player has left and moving every piece which is not pinned,
+        while following the queen restriction. The pinned cells are computed once and shared by all pieces.
 
-    def _get_valid_grasshopper_moves(self, position: Tile):
-        result = set()
+        :param player: the player to move.
+        :return:
+        """
+        owner = player.user.name
+        placeable = [
+            piece for piece, amount in player.pieces.items()
+            if amount > 0 and not player.queen_restriction(piece)
+        ]
 
-        cursor = position
-        while self._get_top_left(cursor) is not None:
-            cursor = self._get_top_left(cursor)
-        if cursor is not position:
-            result.add(_make_top_left(cursor))
-
-        cursor = position
-        while self._get_top_right(cursor) is not None:
-            cursor = self._get_top_right(cursor)
-        if cursor is not position:
-            result.add(_make_top_right(cursor))
-
-        cursor = position
-        while self._get_bottom_left(cursor) is not None:
-            cursor = self._get_bottom_left(cursor)
-        if cursor is not position:
-            result.add(_make_bottom_left(cursor))
-
-        cursor = position
-        while self._get_bottom_right(cursor) is not None:
-            cursor = self._get_bottom_right(cursor)
-        if cursor is not position:
-            result.add(_make_bottom_right(cursor))
-
-        cursor = position
-        # Left horizontally
-        while self.get_tile(cursor.x - 1, cursor.y) is not None:
-            cursor = self.get_tile(cursor.x - 1, cursor.y)
-        if cursor is not position:
-            result.add(Tile(cursor.x - 1, cursor.y))
-
-        cursor = position
-        # Right horizontally
-        while self.get_tile(cursor.x + 1, cursor.y) is not None:
-            cursor = self.get_tile(cursor.x + 1, cursor.y)
-        if cursor is not position:
-            result.add(Tile(cursor.x + 1, cursor.y))
+        # The first two tiles are placed without the usual placement rules.
+        if self.turn_number == 0:
+            return [(piece, None, cell_id(0, 0)) for piece in placeable]
+        elif self.turn_number == 1:
+            tile = self._get_random_tile()
+            targets = self._in_range(NEIGHBOURS[cell_id(tile.x, tile.y)])
+            return [(piece, None, target) for piece in placeable for target in targets]
+
+        moves = []
+        if placeable:
+            targets = self.get_valid_cells(None, owner)
+            moves.extend((piece, None, target) for piece in placeable for target in targets)
+
+        top = self._top
+        pinned = self.get_pinned_cells()
+        for cell in list(self._occupied):
+            tile = self._pieces[top[cell]]
+            if tile.owner != owner or cell in pinned or player.queen_restriction(tile.type):
+                continue
 
-        return result
+            moves.extend((tile.type, cell, target) for target in self.get_valid_cells(cell, owner))
 
-    def _get_valid_queen_moves(self, position, subset):
-        result = set()
+        return moves
 
-        for tile in _make_tiles_around(position):
-            if self.get_tile(tile.x, tile.y) is None \
-                    and self.check_physically_allowed(position, tile):
-                result.add(tile)
+    def _get_side(self, owner) -> int:
+        return self._sides.setdefault(owner, len(self._sides))
+
+    def _get_piece_key(self, tile, cell, height):
+        return piece_key(tile.type, self._get_side(tile.owner), cell, height)
+
+    def _get_piece_moves(self, piece, origin, subset) -> set:
+        if piece == "ant":
+            return self._get_valid_ant_moves(origin, subset)
+        elif piece == "grasshopper":
+            return self._get_valid_grasshopper_moves(origin)
+        elif piece == "queen":
+            return self._get_valid_queen_moves(origin, subset=subset)
+        elif piece == "beetle":
+            return self._get_valid_beetle_moves(origin, subset=subset)
+        elif piece == "spider":
+            return self._get_valid_spider_moves(origin, subset=subset)
+        elif piece == "mosquito":
+            return self._get_valid_mosquito_moves(origin, subset=subset)
+        elif piece == "ladybug":
+            return self._get_valid_ladybug_moves(origin, subset=subset)
+        return set()
 
-        return result.intersection(subset)
+    def get_allied_squares(self, subset: set, player: Player) -> set:
+        cells = set(cell_id(entry.x, entry.y) for entry in subset)
+        return self._make_tiles(self._get_allied_cells(cells, player.user.name))
 
-    @staticmethod
-    def _get_valid_beetle_moves(original_tile, subset):
+    def _get_allied_cells(self, subset: set, owner) -> set:
+        top = self._top
+        pieces = self._pieces
         result = set()
 
-        for tile in _make_tiles_around(original_tile):
-            result.add(tile)
-
-        return result.intersection(subset)
-
-    def _get_valid_mosquito_moves(self, original_tile, subset):
-        result = set()
+        for cell in subset:
+            # Allied squares must be empty, as you cannot initially place tiles on top of another.
+            if top[cell]:
+                continue
 
-        for tile in self.get_tiles_around(original_tile):
-            if tile.type == "ant":
-                result = result.union(self._get_valid_ant_moves(original_tile, subset))
-            elif tile.type == "grasshopper":
-                result = result.union(self._get_valid_grasshopper_moves(original_tile))
-            elif tile.type == "queen":
-                result = result.union(self._get_valid_queen_moves(original_tile, subset=subset))
-            elif tile.type == "beetle":
-                result = result.union(self._get_valid_beetle_moves(original_tile, subset=subset))
-            elif tile.type == "spider":
-                result = result.union(self._get_valid_spider_moves(original_tile, subset=subset))
-            elif tile.type == "ladybug":
-                result = result.union(self._get_valid_ladybug_moves(original_tile, subset=subset))
+            for around in NEIGHBOURS[cell]:
+                code = top[around]
+                if code and pieces[code].owner != owner:
+                    break
+            else:
+                result.add(cell)
 
         return result
 
-    def _get_valid_spider_moves(self, original_tile, subset):
-        checks = set()
-        checks.add(original_tile)
+    def _get_placement_cells(self, owner) -> set:
+        """
+        The empty cells next to the hive which do not touch a piece of another side.
 
-        prev_area = set()
-        area = set()
-        for i in range(3):
-            prev_area = area
-            area = set()
+        :param owner:
+        :return:
+        """
+        return self._get_allied_cells(self._hive, owner)
 
-            # Create area of tiles
-            for check in list(checks):
-                for tile in _make_tiles_around(check):
-                    if tile not in subset:
-                        continue
-                    if self.get_tile(tile.x, tile.y) is None \
-                            and self.check_physically_allowed(check, tile):
-                        area.add(tile)
+    def _get_slides(self, cell, subset):
+        """
+        Empty cells from the subset which a piece on the given cell can slide into.
+        A piece cannot squeeze between the two cells it shares with its destination if both are occupied.
+
+        :param cell:
+        :param subset:
+        :return:
+        """
+        top = self._top
+        around = NEIGHBOURS[cell]
+        return [
+            target for direction, target in enumerate(around)
+            if target in subset and not top[target]
+            and (not top[around[direction - 1]] or not top[around[direction - 5]])
+        ]
+
+    def _get_valid_grasshopper_moves(self, origin):
+        top = self._top
+        result = set()
 
-            checks = area.union(checks)
+        for direction in range(6):
+            cursor = NEIGHBOURS[origin][direction]
+            # The grasshopper has to jump over at least one tile.
+            if not top[cursor]:
+                continue
 
-        result = area - prev_area
+            while top[cursor]:
+                cursor = NEIGHBOURS[cursor][direction]
+            result.add(cursor)
 
         return result
 
-    def _get_valid_ladybug_moves(self, original_tile, subset):
-        result = set()
+    def _get_valid_queen_moves(self, origin, subset):
+        return set(self._get_slides(origin, subset))
 
-        area = set()
-        checks = [original_tile]
-        for i in range(2):
-            area = set()
-            # Create area of tiles
-            for check in checks:
-                for tile in self.get_tiles_around(check):
-                    area.add(tile)
+    @staticmethod
+    def _get_valid_beetle_moves(origin, subset):
+        return set(cell for cell in NEIGHBOURS[origin] if cell in subset)
 
-            checks = [a for a in area]
+    def _get_valid_mosquito_moves(self, origin, subset):
+        result = set()
 
-        for piece in area:
-            for tile in _make_tiles_around(piece):
-                if self.get_tile(tile.x, tile.y) is None:
-                    result.add(tile)
+        pieces = set(tile.type for tile in self._get_tiles_around(origin))
+        pieces.discard("mosquito")
+        for piece in pieces:
+            result.update(self._get_piece_moves(piece, origin, subset))
 
-        return result.intersection(subset)
+        return result
 
-    def _get_valid_ant_moves(self, original_tile, subset):
+    def _get_valid_spider_moves(self, origin, subset):
         """
-        Ants may only move to unoccupied spaces.
+        Spiders move exactly three steps, so the result is the third layer of a breadth first search.
 
-        :param position:
+        :param origin:
         :param subset:
         :return:
         """
-        frontier = [original_tile]
+        visited = {origin}
+        area = [origin]
+        for i in range(3):
+            frontier = area
+            area = []
 
-        result = set()
-        while True:
-            area = set()
             # Create area of tiles
             for check in frontier:
-                for tile in _make_tiles_around(check):
-                    if tile not in subset:
-                        continue
-                    if self.get_tile(tile.x, tile.y) is None \
-                            and self.check_physically_allowed(check, tile):
-                        area.add(tile)
+                for cell in self._get_slides(check, subset):
+                    if cell not in visited:
+                        visited.add(cell)
+                        area.append(cell)
+
+        return set(area)
+
+    def _get_valid_ladybug_moves(self, origin, subset):
+        top = self._top
+
+        # Two steps on top of the hive, then down into an empty square.
+        first = [cell for cell in NEIGHBOURS[origin] if top[cell]]
+        second = set(around for cell in first for around in NEIGHBOURS[cell] if top[around])
 
-            frontier = area.copy()
+        return set(
+            around for cell in second for around in NEIGHBOURS[cell]
+            if not top[around] and around in subset
+        )
 
-            temp_result = result.union(area)
-            if temp_result == result:
-                return temp_result
+    def _get_valid_ant_moves(self, origin, subset):
+        """
+        Ants may only move to unoccupied spaces.
 
-            result = temp_result
+        :param origin:
+        :param subset:
+        :return:
+        """
+        result = set()
+        frontier = [origin]
+        while frontier:
+            check = frontier.pop()
+            for cell in self._get_slides(check, subset):
+                if cell not in result:
+                    result.add(cell)
+                    frontier.append(cell)
 
+        return result
 
     def fix_height(self, tiles: set):
         for tile in tiles:
@@ -459,24 +597,41 @@ class Board:
                 tile.z = board_tile.z + 1
 
     def get_tile(self, x: int, y: int) -> Optional[Tile]:
-        try:
-            temp = self.tiles[y][x]
-            return temp[len(temp) - 1]
-        except (IndexError, KeyError) as e:
-            return None
+        code = self._top[cell_id(x, y)]
+        if code:
+            tile = self._pieces[code]
+            # Cell ids wrap around, so make sure this is not a tile far away.
+            if tile.x == x and tile.y == y:
+                return tile
+        return None
 
     def put_tile(self, tile):
-        if tile.y not in self.tiles:
-            self.tiles[tile.y] = {}
-        if tile.x not in self.tiles[tile.y]:
-            self.tiles[tile.y][tile.x] = []
+        if self._shared:
+            self._unshare()
+
+        if self._free_codes:
+            code = self._free_codes.pop()
+            self._pieces[code] = tile
+        else:
+            code = len(self._pieces)
+            self._pieces.append(tile)
+
+        cell = cell_id(tile.x, tile.y)
+        tile.z = self._get_height(cell)
+        self.hash ^= self._get_piece_key(tile, cell, tile.z)
+        self._push(cell, code)
+        self._anchor = (tile.x, tile.y)
+        self._pinned = None
 
-        tile.z = len(self.tiles[tile.y][tile.x])
-        self.tiles[tile.y][tile.x].append(tile)
+        if tile.type == "queen":
+            self._queens[tile.owner] = tile
 
     def move(self, player: Player, data):
         x = int(data.get("new_x"))
         y = int(data.get("new_y"))
+        if abs(x) > MAX_COORDINATE or abs(y) > MAX_COORDINATE:
+            return False
+
         original_x = data.get("x", None)
         original_y = data.get("y", None)
 
@@ -503,22 +658,156 @@ class Board:
             return False
 
         if self.is_move_valid(original_tile, tile, player):
-            # Remove tile on previous location
+            origin = None
+            previous = None
             if original_tile is not None:
-                self.remove_tile(original_tile.x, original_tile.y)
+                origin = cell_id(original_tile.x, original_tile.y)
+                previous = (original_tile.x, original_tile.y)
 
-            self.put_tile(tile)
+            # The first tile can go anywhere, the cells of later tiles are translated back relative to it.
+            if not self._occupied:
+                self._anchor = (x, y)
 
-            # If this is a new tile, subtract the tile from the amounts
-            if original_tile is None:
-                player.pieces[tile.type] -= 1
-
-            player.turn += 1
-            self.next_turn()
+            self._history.append(self.make_move(player, tile.type, origin, cell_id(x, y)))
+            self._record_delta("place" if origin is None else "move", self.get_tile(x, y), previous)
             return True
 
         return False
 
+    def get_last_mover(self, skip=0) -> Optional[Player]:
+        """
+        Returns the player who made the last move which can be taken back.
+
+        :param skip: the amount of later moves to skip.
+        :return: the player, or None if there is no such move.
+        """
+        if len(self._history) <= skip:
+            return None
+        return self._history[-1 - skip][0]
+
+    def takeback(self) -> Optional[Player]:
+        """
+        Takes back the last move made with move(), returning the tile, the pieces and the turn of the player to
+        how they were before it. Moves played before the board was created from a snapshot cannot be taken back.
+
+        :return: the player whose move was taken back, or None if there is no move to take back.
+        """
+        if not self._history:
+            return None
+
+        undo = self._history.pop()
+        player, _, origin, target, _ = undo
+
+        tile = self._pieces[self._top[target]]
+        self.unmake_move(undo)
+
+        if origin is None:
+            self._record_delta("remove", tile)
+        else:
+            self._record_delta("move", self._pieces[self._top[origin]], (tile.x, tile.y))
+        return player
+
+    def make_move(self, player: Player, piece, origin, target):
+        """
+        Plays a move without validating it, for searching through positions without copying the board.
+        The returned record is passed to unmake_move to restore the previous position, moves have to be unmade in
+        the reverse order they were made in.
+
+        :param player: the player making the move.
+        :param piece: the type of the tile.
+        :param origin: cell id the tile is moved from, or None to place a new tile.
+        :param target: cell id the tile is moved to.
+        :return: the undo record.
+        """
+        undo = (player, piece, origin, target, self._anchor)
+
+        x, y = self._xy(target)
+        if origin is None:
+            tile = Tile(x, y)
+            tile.owner = player.user.name
+            tile.type = piece
+            player.pieces[piece] -= 1
+        else:
+            tile = self.remove_tile(*self._xy(origin)).moved_to(x, y)
+
+        self.put_tile(tile)
+        player.turn += 1
+        self.next_turn()
+        return undo
+
+    def unmake_move(self, undo):
+        player, piece, origin, target, anchor = undo
+
+        if origin is None:
+            self.remove_tile(*self._xy(target))
+            player.pieces[piece] += 1
+        else:
+            x, y = self._xy(origin)
+            self.put_tile(self.remove_tile(*self._xy(target)).moved_to(x, y))
+
+        self._anchor = anchor
+        player.turn -= 1
+        self.turn = (self.turn - 1) % len(self.players)
+        self.turn_number -= 1
+
+    def _record_delta(self, action, tile, previous=None):
+        """
+        Adds a change of the board to the delta log.
+
+        :param action: "place", "move", or "remove" for the top tile of a cell.
+        :param tile: the tile which was placed, moved or removed.
+        :param previous: the (x, y) coordinates a moved tile came from.
+        """
+        self.sequence += 1
+        delta = {
+            "sequence": self.sequence,
+            "action": action,
+            "x": tile.x,
+            "y": tile.y,
+            "z": tile.z,
+            "owner": tile.owner,
+            "type": tile.type
+        }
+        if previous is not None:
+            delta["from_x"], delta["from_y"] = previous
+
+        self._deltas.append(delta)
+
+    def get_deltas(self, epoch, sequence) -> Optional[list]:
+        """
+        Returns the moves made after the given sequence number, oldest first.
+
+        :param epoch: the epoch of the board the client has.
+        :param sequence: the last sequence number the client has seen.
+        :return: the list of moves, or None if the client needs the whole board instead.
+        """
+        if epoch != self.epoch or sequence is None or not 0 <= sequence <= self.sequence:
+            return None
+
+        missing = self.sequence - sequence
+        if missing > len(self._deltas):
+            return None
+
+        return list(self._deltas)[len(self._deltas) - missing:]
+
+    def get_payload(self, name, encode):
+        """
+        Returns a payload of the current version of the board, which is only encoded once per version.
+
+        :param name: the name of the payload, e.g. the event it is sent with.
+        :param encode: function creating the payload from the board.
+        :return:
+        """
+        version = (self.epoch, self.sequence)
+        if self._payload_version != version:
+            self._payload_version = version
+            self._payloads.clear()
+
+        payload = self._payloads.get(name)
+        if payload is None:
+            payload = self._payloads[name] = encode(self)
+        return payload
+
     def export_valid_moves(self, x, y, user):
         # This get can only fail if the user makes an invalid request.
         original_tile = self.get_tile(x, y)
@@ -527,16 +816,34 @@ class Board:
         self.fix_height(moves)
         return moves
 
-    def get_tiles_around(self, tile):
-        tiles = []
+    def get_top_tiles(self) -> list:
+        top = self._top
+        return [self._pieces[top[cell]] for cell in self._occupied]
 
-        surroundings = _make_tiles_around(tile)
-        for around in surroundings:
-            hive_tile = self.get_tile(around.x, around.y)
-            if hive_tile is not None:
-                tiles.append(hive_tile)
+    def get_queens(self) -> dict:
+        """
+        Returns the queens on the board by the name of their owner.
 
-        return tiles
+        :return:
+        """
+        return dict(self._queens)
+
+    def get_queen_neighbours(self) -> dict:
+        """
+        Returns the amount of occupied cells around the queens on the board by the name of their owner,
+        a queen with 6 is surrounded.
+
+        :return:
+        """
+        neighbours = self._neighbours
+        return dict((owner, neighbours[cell_id(tile.x, tile.y)]) for owner, tile in self._queens.items())
+
+    def get_tiles_around(self, tile):
+        return self._get_tiles_around(cell_id(tile.x, tile.y))
+
+    def _get_tiles_around(self, cell):
+        top = self._top
+        return [self._pieces[top[around]] for around in NEIGHBOURS[cell] if top[around]]
 
     def breaks_hive(self, move):
         """
@@ -546,39 +853,171 @@ class Board:
         :param move:
         :return:
         """
+        return cell_id(move.x, move.y) in self.get_pinned_cells()
 
-        excluded = self.tiles[move.y][move.x].pop()
-
-        hive_tiles = set()
-        for y, row in self.tiles.items():
-            for x, _ in row.items():
-                tile = self.get_tile(x, y)
-                if tile is not None:
-                    hive_tiles.add(tile)
+    def get_pinned_cells(self) -> set:
+        """
+        Returns the cells whose top tile cannot be moved without splitting the hive.
+        These are the articulation points of the hive, found with a single pass of Tarjan's algorithm
+        which is only repeated after the board has changed.
 
-        # Do a breadth first search starting from a random tile.
-        # If the resulting set contains all tiles, it is valid
-        starting_point = self._get_random_tile()
+        :return:
+        """
+        if self._pinned is None:
+            self._pinned = self._find_articulation_cells()
+        return self._pinned
+
+    def export_pinned_tiles(self):
+        return [{"x": x, "y": y} for x, y in map(self._xy, self.get_pinned_cells())]
+
+    def _find_articulation_cells(self) -> set:
+        top = self._top
+        pinned = set()
+
+        root = next(iter(self._occupied), None)
+        if root is None:
+            return pinned
+
+        order = {root: 0}
+        low = {root: 0}
+        root_children = 0
+
+        # Iterative depth first search, every entry holds the cell, its parent and the remaining neighbours.
+        stack = [(root, None, iter(NEIGHBOURS[root]))]
+        while stack:
+            cell, parent, around = stack[-1]
+            for neighbour in around:
+                if not top[neighbour] or neighbour == parent:
+                    continue
+                if neighbour in order:
+                    low[cell] = min(low[cell], order[neighbour])
+                else:
+                    order[neighbour] = low[neighbour] = len(order)
+                    stack.append((neighbour, cell, iter(NEIGHBOURS[neighbour])))
+                    break
+            else:
+                stack.pop()
+                if parent is None:
+                    continue
 
-        bfs_tiles = set()
-        frontier = [starting_point]
+                low[parent] = min(low[parent], low[cell])
+                if parent == root:
+                    root_children += 1
+                elif low[cell] >= order[parent]:
+                    pinned.add(parent)
 
-        while len(frontier) != 0 and starting_point is not None:
-            selection = frontier.pop()
-            bfs_tiles.add(selection)
-            for tile in self.get_tiles_around(selection):
-                # Only add tiles to frontier if it has not yet been added to the list.
-                if tile not in bfs_tiles:
-                    frontier.append(tile)
+        if root_children > 1:
+            pinned.add(root)
 
-        self.put_tile(excluded)
+        # A hive which is already split cannot lose any more tiles.
+        if len(order) != len(self._occupied):
+            pinned = set(self._occupied)
 
-        return bfs_tiles != hive_tiles
+        # Picking up a tile from a stack leaves the tile underneath in place.
+        return set(cell for cell in pinned if cell not in self._below)
 
     def remove_tile(self, x, y):
-        self.tiles[y][x].pop()
-        if len(self.tiles[y][x]) == 0:
-            del self.tiles[y][x]
+        cell = cell_id(x, y)
+        if not self._top[cell]:
+            raise ValueError("There is no tile on (%d, %d) to remove." % (x, y))
+
+        code = self._pop(cell)
+        tile = self._pieces[code]
+        self.hash ^= self._get_piece_key(tile, cell, tile.z)
+        self._pieces[code] = None
+        self._free_codes.append(code)
+        self._pinned = None
+
+        if tile.type == "queen":
+            del self._queens[tile.owner]
+        return tile
+
+    def snapshot(self) -> BoardSnapshot:
+        stacks = []
+        for cell in self._occupied:
+            codes = self._below.get(cell, []) + [self._top[cell]]
+            top = self._pieces[codes[-1]]
+            stacks.append((top.x, top.y, tuple((self._pieces[code].type, self._pieces[code].owner) for code in codes)))
+
+        players = tuple(
+            (player.user.name, player.user.elo, tuple(player.pieces.items()), player.turn)
+            for player in self.players
+        )
+        sides = tuple(sorted(self._sides, key=self._sides.get))
+
+        return BoardSnapshot(tuple(stacks), sides, players, self.turn, self.turn_number, self.hash)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: BoardSnapshot):
+        """
+        Creates a board from a snapshot. The players are not connected to the database.
+
+        :param snapshot:
+        :return:
+        """
+        board = cls()
+        for side, owner in enumerate(snapshot.sides):
+            board._sides[owner] = side
+
+        for x, y, stack in snapshot.stacks:
+            for piece, owner in stack:
+                tile = Tile(x, y)
+                tile.type = piece
+                tile.owner = owner
+                board.put_tile(tile)
+
+        for name, elo, pieces, turn in snapshot.players:
+            player = Player(board, DetachedUser(name, elo))
+            player.pieces = dict(pieces)
+            player.turn = turn
+            board.players.append(player)
+
+        board.turn = snapshot.turn
+        board.turn_number = snapshot.turn_number
+        return board
+
+    def clone(self):
+        """
+        Returns an independent copy of the game, to analyse positions next to the live game.
+        Both boards share their state until either of them changes it, so this does not depend on the size of the
+        hive. The players of the copy are detached from the database, and it has no moves to take back.
+
+        :return:
+        """
+        board = type(self).__new__(type(self))
+        board.__dict__.update(self.__dict__)
+        board._shared = self._shared = True
+
+        # State which also changes without a move is never shared.
+        board._sides = dict(self._sides)
+        board._move_cache = OrderedDict()
+        board._history = []
+        board._deltas = deque(maxlen=DELTA_LOG_SIZE)
+        board._payload_version = None
+        board._payloads = {}
+
+        board.players = [board._detach(player) for player in self.players]
+        board.spectators = [board._detach(player) for player in self.spectators]
+        return board
+
+    def _detach(self, player: Player) -> Player:
+        user = player.user
+        copy = Player(self, DetachedUser(user.name, user.elo, user.id))
+        copy.pieces = dict(player.pieces)
+        copy.turn = player.turn
+        return copy
+
+    def _unshare(self):
+        # Copy the state shared with a clone before the first change.
+        self._top = bytearray(self._top)
+        self._neighbours = bytearray(self._neighbours)
+        self._below = dict((cell, list(codes)) for cell, codes in self._below.items())
+        self._occupied = set(self._occupied)
+        self._hive = set(self._hive)
+        self._pieces = list(self._pieces)
+        self._free_codes = list(self._free_codes)
+        self._queens = dict(self._queens)
+        self._shared = False
 
     def get_player(self, name) -> Optional[Player]:
         for player in self.players:
@@ -588,19 +1027,8 @@ class Board:
         return None
 
     def get_player_list(self):
-        players = [{
-            "name": player.user.name,
-            "elo": player.user.elo,
-            "type": "player",
-            "turn": self.get_turn() == player
-        } for player in self.players]
-
-        spectators = [{
-            "name": player.user.name,
-            "elo": player.user.elo,
-            "type": "spectator",
-            "turn": False
-        } for player in self.spectators]
+        players = [encode_player(player, "player", self.get_turn() == player) for player in self.players]
+        spectators = [encode_player(player, "spectator", False) for player in self.spectators]
 
         return players + spectators
 
@@ -609,57 +1037,44 @@ class Board:
         if player is not None:
             self.players.remove(player)
         else:
-            self.spectators.remove(username)
+            self.spectators = [spectator for spectator in self.spectators if spectator.user.name != username]
 
     def finished(self):
-        for y, row in self.tiles.items():
-            for x, tiles in row.items():
-                for tile in tiles:
-                    if tile.type == "queen" and len(self.get_tiles_around(tile)) == 6:
-                        self.loser = tile.owner
+        neighbours = self._neighbours
+        surrounded = [owner for owner, tile in self._queens.items() if neighbours[cell_id(tile.x, tile.y)] == 6]
+        if not surrounded:
+            return False
 
-                        for player in self.players:
-                            if player.user.name != self.loser:
-                                self.winner = player.user.name
+        # Surrounding both queens with the same move ends the game in a draw.
+        if len(surrounded) > 1:
+            self.draw = True
+            return True
 
-                        return True
+        self.loser = surrounded[0]
+        for player in self.players:
+            if player.user.name != self.loser:
+                self.winner = player.user.name
 
-        return False
+        return True
 
     def check_physically_allowed(self, position: Tile, tile: Tile):
-        direction = get_direction(position, tile)
-        if direction is None:
+        around = NEIGHBOURS[cell_id(position.x, position.y)]
+        target = cell_id(tile.x, tile.y)
+        if target not in around:
             raise ValueError("Cannot check when tiles are more than 1 space apart.")
 
-        tr = self._get_top_right(position) is None
-        left = self.get_tile(position.x - 1, position.y) is None
-        if direction == Directions.TOP_LEFT:
-            return tr or left
-
-        br = self._get_bottom_right(position) is None
-        if direction == Directions.BOTTOM_LEFT:
-            return br or left
-        if direction == Directions.RIGHT:
-            return tr or br
-
-        tl = self._get_top_left(position) is None
-        bl = self._get_bottom_left(position) is None
-        if direction == Directions.LEFT:
-            return tl or bl
-
-        right = self.get_tile(position.x + 1, position.y) is None
-        if direction == Directions.TOP_RIGHT:
-            return tl or right
-        if direction == Directions.BOTTOM_RIGHT:
-            return bl or right
+        # The two cells shared with the destination are the neighbouring directions.
+        direction = around.index(target)
+        return not self._top[around[direction - 1]] or not self._top[around[direction - 5]]
 
     def reset_game(self):
-        self.tiles = {}
+        self._clear()
 
         self.turn = 0
         self.turn_number = 0
         self.winner = None
         self.loser = None
+        self.draw = False
 
         for player in self.players:
             player.reset()
@@ -2,12 +2,33 @@
 # Used to track all player related information.
 # For example; if it is the player's turn, a reference to the game board, and the amount of pieces allowed to play.
 #
-from project.database import user_service
-from project.database.models import UserModel
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from project.database.models import UserModel
+
+
+class DetachedUser:
+    """
+    A user as seen by the game, standing in for a UserModel. The server seats every player as a detached user, so
+    the game never touches the database, also for players which do not live in it such as the CPU.
+    """
+
+    def __init__(self, name: str, elo: float = 1200, uid: int = None):
+        self.id = uid
+        self.name = name
+        self.elo = elo
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "elo": self.elo
+        }
 
 
 class Player:
-    def __init__(self, board, user: UserModel):
+    def __init__(self, board, user: "UserModel"):
         self.board = board
         self.user = user
         self.pieces = {
@@ -41,7 +62,6 @@ class Player:
         return False
 
     def reset(self):
-        self.user = user_service.get_user(name=self.user.name)
         self.pieces = {
             "queen": 1,
             "spider": 2,
@@ -0,0 +1,7 @@
+#
+# The rules of the game: the board, the pieces, move generation and the CPU engine.
+#
+# Nothing in this package imports Flask, the database or the config, so worker processes and offline tools such as
+# benchmarks/perft.py can use it without starting the server. Players are identified by their name, and the socket
+# layer seats them as DetachedUser.
+#
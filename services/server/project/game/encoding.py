@@ -0,0 +1,119 @@
+#
+# Explicit encoders for the payloads sent to clients.
+#
+# Every encoder only writes the fields the client reads, so encoding a tile is a single dict literal
+# instead of inspecting the object. The results are plain lists and dicts, which can be emitted as they are
+# or turned into a string with dumps.
+#
+# Clients can also ask for a binary format, in which pieces are small integer codes and coordinates are packed
+# little endian integers. All strings are prefixed with their length in bytes as an unsigned short.
+#
+import json
+import struct
+
+from project.game.zobrist import PIECES
+
+# Piece codes of the binary format, the client uses the same order.
+PIECE_CODES = dict((piece, code) for code, piece in enumerate(PIECES))
+
+_STRING_LENGTH = struct.Struct("<H")
+_COUNT = struct.Struct("<H")
+_BOARD_HEADER = struct.Struct("<16sIB")
+# x, y, z, piece code, owner index
+_BOARD_TILE = struct.Struct("<hhBBB")
+# x, y, z
+_MOVE = struct.Struct("<hhB")
+# x, y, z, piece code
+_PLACE_TILE = struct.Struct("<hhBB")
+
+
+def encode_tile(tile) -> dict:
+    return {
+        "x": tile.x,
+        "y": tile.y,
+        "z": tile.z,
+        "owner": tile.owner,
+        "type": tile.type
+    }
+
+
+def encode_board(tiles: dict) -> dict:
+    """
+    Encodes the tiles of a board.
+
+    :param tiles: the tiles as {y: {x: [tiles from bottom to top]}}, see Board.tiles.
+    :return: the encoded tiles in the same layout.
+    """
+    return dict(
+        (y, dict((x, [encode_tile(tile) for tile in stack]) for x, stack in row.items()))
+        for y, row in tiles.items()
+    )
+
+
+def encode_moves(tiles) -> list:
+    """
+    Encodes a set of positions a tile can move to, of which only the location is used.
+
+    :param tiles:
+    :return:
+    """
+    return [{"x": tile.x, "y": tile.y, "z": tile.z} for tile in tiles]
+
+
+def encode_player(player, player_type: str, turn: bool) -> dict:
+    return {
+        "name": player.user.name,
+        "elo": player.user.elo,
+        "type": player_type,
+        "turn": turn
+    }
+
+
+def dumps(payload) -> str:
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def _pack_string(text: str) -> bytes:
+    data = text.encode()
+    return _STRING_LENGTH.pack(len(data)) + data
+
+
+def pack_board(epoch: str, sequence: int, tiles: dict) -> bytes:
+    """
+    Packs the tiles of a board into the binary format.
+
+    The board is an epoch of 16 bytes, the sequence number, the owner names,
+    and then every tile from the bottom to the top of its stack as x, y, z, piece code and owner index.
+
+    :param epoch: the epoch of the board as 32 hexadecimal digits.
+    :param sequence:
+    :param tiles: the tiles as {y: {x: [tiles from bottom to top]}}, see Board.tiles.
+    :return:
+    """
+    owners = {}
+    records = []
+    for row in tiles.values():
+        for stack in row.values():
+            for tile in stack:
+                owner = owners.setdefault(tile.owner, len(owners))
+                records.append(_BOARD_TILE.pack(tile.x, tile.y, tile.z, PIECE_CODES[tile.type], owner))
+
+    parts = [_BOARD_HEADER.pack(bytes.fromhex(epoch), sequence, len(owners))]
+    parts.extend(_pack_string(owner) for owner in owners)
+    parts.append(_COUNT.pack(len(records)))
+    parts.extend(records)
+    return b"".join(parts)
+
+
+def pack_moves(tiles) -> bytes:
+    """
+    Packs a set of positions a tile can move to as a count followed by x, y and z of every position.
+
+    :param tiles:
+    :return:
+    """
+    return _COUNT.pack(len(tiles)) + b"".join(_MOVE.pack(tile.x, tile.y, tile.z) for tile in tiles)
+
+
+def pack_place_tile(username: str, x: int, y: int, z: int, piece: str) -> bytes:
+    return _pack_string(username) + _PLACE_TILE.pack(x, y, z, PIECE_CODES[piece])
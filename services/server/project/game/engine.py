@@ -0,0 +1,268 @@
+#
+# Search based CPU opponent.
+#
+# Negamax with alpha-beta pruning and iterative deepening, using a transposition table keyed by the Zobrist hash of
+# the board. Moves are played and taken back with Board.make_move and Board.unmake_move, so the search never copies
+# the board. The search stops at a deadline and then answers with the best move of the deepest finished iteration.
+#
+import time
+from typing import Optional
+
+from project.game.Board import Board, BoardSnapshot
+from project.game.grid import NEIGHBOURS, cell_id
+
+DEFAULT_MAX_DEPTH = 3
+DEFAULT_TIME_LIMIT = 1.0
+
+# Maximum amount of positions in the transposition table before it is cleared.
+TABLE_SIZE = 200000
+
+WIN_SCORE = 100000
+QUEEN_WEIGHT = 100
+MOBILITY_WEIGHT = 5
+
+_EXACT = 0
+_LOWER = 1
+_UPPER = 2
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+# Engines of a worker process, kept so their transposition tables are reused for the next move.
+_engines = {}
+
+
+class Engine:
+    def __init__(self, max_depth=DEFAULT_MAX_DEPTH, time_limit=DEFAULT_TIME_LIMIT):
+        self.max_depth = max_depth
+        self.time_limit = time_limit
+        self.table = {}
+        self.nodes = 0
+        self.depth = 0
+        self.deadline = None
+
+    def select_move(self, board, player) -> Optional[dict]:
+        """
+        Searches for the best move of the player, within the depth and time limits of the engine.
+
+        :param board: the board, which is left unchanged.
+        :param player: the player to move, this must be the player whose turn it is.
+        :return: the move in the same format as the data of a placeTile request, or None if there is no move.
+        """
+        self.nodes = 0
+        self.depth = 0
+        self.deadline = time.monotonic() + self.time_limit
+        if len(self.table) > TABLE_SIZE:
+            self.table.clear()
+
+        moves = board.get_legal_moves(player)
+        if len(moves) == 0:
+            return None
+
+        best = self._order_moves(board, player, moves, None)[0]
+        for depth in range(1, self.max_depth + 1):
+            try:
+                best = self._search_root(board, player, moves, depth, best)
+            except SearchTimeout:
+                break
+
+            self.depth = depth
+
+        return export_move(board, best)
+
+    def _search_root(self, board, player, moves, depth, previous_best):
+        alpha = -WIN_SCORE - 1
+        beta = WIN_SCORE + 1
+        best = previous_best
+
+        for move in self._order_moves(board, player, moves, previous_best):
+            undo = board.make_move(player, *move)
+            try:
+                score = -self._search(board, depth - 1, -beta, -alpha, 1)
+            finally:
+                board.unmake_move(undo)
+
+            if score > alpha:
+                alpha = score
+                best = move
+
+        self.table[self._key(board)] = (depth, alpha, _EXACT, best)
+        return best
+
+    def _search(self, board, depth, alpha, beta, ply):
+        self.nodes += 1
+        if time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+        player = board.get_turn()
+        outcome = self._get_outcome(board, player, ply)
+        if outcome is not None:
+            return outcome
+
+        if depth == 0:
+            return evaluate(board, player)
+
+        key = self._key(board)
+        entry = self.table.get(key)
+        table_move = None
+        if entry is not None:
+            entry_depth, score, flag, table_move = entry
+            if entry_depth >= depth:
+                if flag == _EXACT:
+                    return score
+                elif flag == _LOWER:
+                    alpha = max(alpha, score)
+                elif flag == _UPPER:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score
+
+        moves = board.get_legal_moves(player)
+        if len(moves) == 0:
+            # A player without moves has to pass, which is not supported by the board, so stop searching here.
+            return evaluate(board, player)
+
+        original_alpha = alpha
+        best_score = -WIN_SCORE - 1
+        best_move = None
+        for move in self._order_moves(board, player, moves, table_move):
+            undo = board.make_move(player, *move)
+            try:
+                score = -self._search(board, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.unmake_move(undo)
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        if best_score <= original_alpha:
+            flag = _UPPER
+        elif best_score >= beta:
+            flag = _LOWER
+        else:
+            flag = _EXACT
+        self.table[key] = (depth, best_score, flag, best_move)
+
+        return best_score
+
+    @staticmethod
+    def _key(board):
+        return board.hash, board.turn, min(board.turn_number, 8)
+
+    @staticmethod
+    def _order_moves(board, player, moves, first_move):
+        """
+        Tries the best move of a previous search first, then moves surrounding the enemy queen,
+        then moves of tiles that are not yet near it.
+
+        :param board:
+        :param player:
+        :param moves:
+        :param first_move:
+        :return:
+        """
+        attack = set()
+        for owner, queen in board.get_queens().items():
+            if owner != player.user.name:
+                attack.update(NEIGHBOURS[cell_id(queen.x, queen.y)])
+
+        def priority(move):
+            if move == first_move:
+                return -3
+            _, origin, target = move
+            score = 0
+            if target in attack:
+                score -= 2
+            if origin is not None and origin not in attack:
+                score -= 1
+            return score
+
+        return sorted(moves, key=priority)
+
+    @staticmethod
+    def _get_outcome(board, player, ply):
+        own = enemy = False
+        for owner, amount in board.get_queen_neighbours().items():
+            if amount == 6:
+                if owner == player.user.name:
+                    own = True
+                else:
+                    enemy = True
+
+        if own and enemy:
+            return 0
+        # Prefer faster wins and slower losses.
+        if enemy:
+            return WIN_SCORE - ply
+        if own:
+            return -WIN_SCORE + ply
+        return None
+
+
+def export_move(board, move) -> dict:
+    """
+    Translates a move of Board.get_legal_moves into the data of a placeTile request.
+
+    :param board:
+    :param move: a (piece, origin cell or None, target cell) tuple.
+    :return:
+    """
+    piece, origin, target = move
+    x, y = board.get_coordinates(target)
+    data = {
+        "new_x": x,
+        "new_y": y,
+        "image": piece
+    }
+    if origin is not None:
+        data["x"], data["y"] = board.get_coordinates(origin)
+
+    return data
+
+
+def evaluate(board, player) -> int:
+    """
+    Scores the position for the player, counting the tiles around both queens and the tiles that can move.
+
+    :param board:
+    :param player:
+    :return:
+    """
+    name = player.user.name
+    score = 0
+
+    for owner, amount in board.get_queen_neighbours().items():
+        surrounded = amount * QUEEN_WEIGHT
+        score += -surrounded if owner == name else surrounded
+
+    pinned = board.get_pinned_cells()
+    for tile in board.get_top_tiles():
+        if cell_id(tile.x, tile.y) in pinned:
+            continue
+        score += MOBILITY_WEIGHT if tile.owner == name else -MOBILITY_WEIGHT
+
+    return score
+
+
+def search_snapshot(snapshot: BoardSnapshot, max_depth=DEFAULT_MAX_DEPTH, time_limit=DEFAULT_TIME_LIMIT):
+    """
+    Selects a move for the player whose turn it is in the snapshot, to be run in a worker process.
+
+    :param snapshot:
+    :param max_depth:
+    :param time_limit:
+    :return: the move in the same format as the data of a placeTile request, or None if there is no move.
+    """
+    board = Board.from_snapshot(snapshot)
+
+    engine = _engines.get((max_depth, time_limit))
+    if engine is None:
+        engine = _engines[(max_depth, time_limit)] = Engine(max_depth, time_limit)
+
+    return engine.select_move(board, board.get_turn())
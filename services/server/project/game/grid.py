@@ -0,0 +1,54 @@
+#
+# Integer cell ids for the hexagonal board.
+#
+# The board uses "odd-r" offset coordinates, odd rows are shifted half a tile to the right.
+# Coordinates are wrapped onto a SIZE x SIZE torus so every cell has a small integer id which can index flat arrays.
+# A hive has at most 26 pieces, so all pieces and the empty cells around them are always less than SIZE / 2 apart,
+# which makes the wrapped ids unique and lets them be translated back relative to any occupied cell.
+#
+SHIFT = 6
+SIZE = 1 << SHIFT
+MASK = SIZE - 1
+HALF = SIZE // 2
+CELLS = SIZE * SIZE
+
+# Largest distance of a tile from the origin. The coordinates of tiles and of the empty cells next to them, which are
+# sent as possible moves, have to fit in the 16 bits the binary wire format uses.
+MAX_COORDINATE = (1 << 15) - 2
+
+# Neighbour offsets in clockwise order, starting to the right.
+# Because the order is a ring, the two cells shared by a cell and its neighbour in direction d are d - 1 and d + 1.
+_EVEN_ROW_OFFSETS = ((1, 0), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1))
+_ODD_ROW_OFFSETS = ((1, 0), (1, 1), (0, 1), (-1, 0), (0, -1), (1, -1))
+
+
+def cell_id(x: int, y: int) -> int:
+    return ((y & MASK) << SHIFT) | (x & MASK)
+
+
+def relative_xy(cell: int, x: int, y: int):
+    """
+    Translate a cell id back into board coordinates, relative to a known cell (x, y) close to it.
+
+    :param cell: the cell id to translate.
+    :param x: x coordinate of a reference cell less than HALF away.
+    :param y: y coordinate of a reference cell less than HALF away.
+    :return: the (x, y) coordinates of the cell.
+    """
+    dx = (((cell & MASK) - x + HALF) & MASK) - HALF
+    dy = (((cell >> SHIFT) - y + HALF) & MASK) - HALF
+    return x + dx, y + dy
+
+
+def _make_neighbours():
+    table = []
+    for cell in range(CELLS):
+        x = cell & MASK
+        y = cell >> SHIFT
+        offsets = _ODD_ROW_OFFSETS if y % 2 else _EVEN_ROW_OFFSETS
+        table.append(tuple(cell_id(x + dx, y + dy) for dx, dy in offsets))
+    return tuple(table)
+
+
+# NEIGHBOURS[cell][d] is the id of the neighbouring cell in direction d.
+NEIGHBOURS = _make_neighbours()
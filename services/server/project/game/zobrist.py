@@ -0,0 +1,35 @@
+#
+# Zobrist keys for hashing board positions.
+#
+# Every (piece, side, cell, height) combination gets a pseudo random 64 bit key, and the hash of a position is the
+# XOR of the keys of all pieces on the board. Placing or removing a piece therefore updates the hash with one XOR.
+# The keys are derived with splitmix64 instead of a random table, so they are the same in every process.
+#
+from project.game.grid import CELLS
+
+PIECES = ("queen", "spider", "beetle", "grasshopper", "ant", "mosquito", "ladybug")
+
+_PIECE_INDEX = dict((piece, index) for index, piece in enumerate(PIECES))
+_MASK64 = (1 << 64) - 1
+
+
+def _splitmix64(value):
+    value = (value + 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+
+def piece_key(piece: str, side: int, cell: int, height: int) -> int:
+    """
+    The key of a single piece on the board.
+
+    :param piece: the piece type, e.g. "queen".
+    :param side: the index of the owner of the piece.
+    :param cell: the cell id the piece is on.
+    :param height: the height of the piece in its stack, 0 for pieces on the ground.
+    :return: a 64 bit key.
+    """
+    index = _PIECE_INDEX.get(piece, len(PIECES))
+    feature = ((index * 8 + side) * 16 + height) * CELLS + cell
+    return _splitmix64(feature)
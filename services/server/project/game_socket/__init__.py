@@ -1 +1,2 @@
 import project.game_socket.game
+import project.game_socket.matchmaking
@@ -1,52 +1,62 @@
-import _thread
-import inspect
-import json
-from collections import defaultdict
+from typing import NamedTuple
 
+from flask import request, session
 from flask_socketio import emit, join_room, leave_room
 
-from project.database import user_service
+from project.actors import droppable
+from project.cluster import cluster
+from project.database import game_service, user_service
 from project.database.models import UserModel
 from project.game.Board import Board
+from project.game.Player import DetachedUser
+from project.game.encoding import dumps, encode_board, encode_moves, pack_board, pack_moves, pack_place_tile
+from project.game.engine import export_move, search_snapshot
+from project.game_socket.hover import HoverCoalescer
 from project.manage import sio
+from project.rooms import rooms
 from project.session import session_user
+from project.workers import JobCancelled, JobTimeout, WorkerError, pool
+
+CPU_NAME = "CPU"
+
+# Maximum search depth and time in seconds for a single CPU move, unless config.ini sets them.
+DEFAULT_CPU_MAX_DEPTH = 3
+DEFAULT_CPU_TIME_LIMIT = 1.0
+# Extra seconds a worker gets to send back the CPU move before it is restarted.
+CPU_GRACE_TIME = 1.0
+
+# Formats clients can ask for when joining, the binary format is used for boardState, markedTiles and placeTile.
+JSON_FORMAT = "json"
+BINARY_FORMAT = "binary"
+# Clients which send neither a format nor the sequence of their board predate both, and get the boardState as only the
+# tiles, without its epoch and sequence.
+LEGACY_FORMAT = "legacy"
+
+
+class Client(NamedTuple):
+    """
+    The client which sent an event. The game functions below can run on another node than the one the client is
+    connected to, so they emit to the client by its session id instead of relying on the request.
+    """
+    sid: str
+    wire_format: str
 
-games = defaultdict(Board)
-
-
-class ObjectEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if hasattr(obj, "to_json"):
-            return self.default(obj.to_json())
-        elif hasattr(obj, "__dict__"):
-            d = dict(
-                (key, value)
-                for key, value in inspect.getmembers(obj)
-                if not key.startswith("__")
-                and not inspect.isabstract(value)
-                and not inspect.isbuiltin(value)
-                and not inspect.isfunction(value)
-                and not inspect.isgenerator(value)
-                and not inspect.isgeneratorfunction(value)
-                and not inspect.ismethod(value)
-                and not inspect.ismethoddescriptor(value)
-                and not inspect.isroutine(value)
-            )
-            return self.default(d)
-        return obj
-
-
-def system_chat(text, room=None):
-    if room is None:
-        emit("chatMessage", {
-            "name": "SYSTEM",
-            "message": text
-        }, json=True, include_self=True)
-    else:
-        emit("chatMessage", {
-            "name": "SYSTEM",
-            "message": text
-        }, json=True, include_self=True, room=room)
+
+def current_client() -> Client:
+    return Client(request.sid, session.get("wire_format", JSON_FORMAT))
+
+
+def system_chat(text, to):
+    """
+    Sends a chat message from the system.
+
+    :param text:
+    :param to: a room, or the session id of a single client.
+    """
+    sio.emit("chatMessage", {
+        "name": "SYSTEM",
+        "message": text
+    }, to=to)
 
 
 @sio.on("join")
@@ -55,21 +65,39 @@ def on_join(data):
     if user is None:
         return
 
-    print(user.name, user.id)
-
     room = data.get("room")
     join_room(room)
 
-    game = games[room]
-    username = user.name
+    # Clients which do not ask for a format get JSON.
+    wire_format = data.get("format")
+    if wire_format not in (JSON_FORMAT, BINARY_FORMAT):
+        wire_format = JSON_FORMAT if "sequence" in data else LEGACY_FORMAT
+    session["wire_format"] = wire_format
+    join_room(format_room(room, wire_format))
 
-    update_board(room)
+    cluster.dispatch(room, join_game, current_client(), room, user.id, user.name,
+                     data.get("epoch"), data.get("sequence"))
+
+
+@cluster.handler
+def join_game(client, room, user_id, username, epoch, sequence):
+    game = rooms.create(room)
+
+    update_board(client, room, epoch, sequence)
 
     # The player has already joined.
     if game.get_player(username) is None:
+        user = user_service.get_cached_user(uid=user_id)
+        if user is None:
+            return
+
         # Adds the current player to the room as either spectator or player depending on if they are quick enough.
         player_type = game.add_player(user)
-        system_chat("%s has joined as %s" % (user.name, player_type), room=room)
+        system_chat("%s has joined as %s" % (user.name, player_type), room)
+
+        # Take the remaining seat in CPU rooms.
+        if is_cpu_room(room) and game.get_player(CPU_NAME) is None and len(game.players) < game.max_players:
+            game.add_player(make_cpu_user())
 
     # Update everybody's player and spectator list.
     update_userlist(room)
@@ -77,50 +105,131 @@ def on_join(data):
     # Send the joined user his remaining tiles
     player = game.get_player(username)
     if player is not None:
-        emit("tileAmounts", player.get_tile_amounts(), json=True, include_self=True)
+        sio.emit("tileAmounts", player.get_tile_amounts(), to=client.sid)
+
+
+def format_room(room, wire_format):
+    # Every room has a sub room per format, so events can be encoded once for all clients using it.
+    return "%s\0%s" % (room, wire_format)
+
+
+def emit_encoded(event, payload, binary_payload, room, legacy_payload=None):
+    """
+    Sends an event to everybody in the room, in the format each client asked for.
+    This uses the server to emit, so it also works outside of a request.
+    Legacy clients get the JSON payload, unless the event has a legacy payload of its own.
+    """
+    sio.emit(event, payload, room=format_room(room, JSON_FORMAT))
+    sio.emit(event, binary_payload, room=format_room(room, BINARY_FORMAT))
+    sio.emit(event, payload if legacy_payload is None else legacy_payload, room=format_room(room, LEGACY_FORMAT))
 
 
 def update_userlist(room):
-    emit("userList", games[room].get_player_list(), json=True, room=room, include_self=True)
+    game = rooms.get(room)
+    if game is not None:
+        sio.emit("userList", game.get_player_list(), room=room)
+
 
+@cluster.handler
+@droppable
+def update_board(client, room, epoch=None, sequence=None):
+    """
+    Brings a client up to date with the board. Clients which know the epoch and sequence number of their last update
+    only receive the moves made since, everybody else receives the whole board.
+    """
+    # Rooms without a game have nothing to send, and should not start one either.
+    game = rooms.get(room)
+    if game is None:
+        return
 
-def update_board(room, to_room=False):
-    game = games[room]
-    board_state = json.dumps(game.tiles, cls=ObjectEncoder)
-    if to_room:
-        emit("boardState", board_state, json=True, include_self=True, room=room)
+    deltas = game.get_deltas(epoch, sequence)
+    if deltas is None:
+        event = "boardState"
+        board_state = export_board_state(game, client.wire_format)
     else:
-        emit("boardState", board_state, json=True, include_self=True)
+        event = "boardDelta"
+        board_state = {
+            "epoch": game.epoch,
+            "sequence": game.sequence,
+            "deltas": deltas
+        }
+
+    sio.emit(event, board_state, to=client.sid)
+
+    # The pinned tiles only change together with the board.
+    if deltas is None or len(deltas) > 0:
+        update_pinned(client, game)
+
+
+def export_board_state(game, wire_format=JSON_FORMAT):
+    # Encoded once per board version, repeated requests and spectators joining get the same payload.
+    if wire_format == BINARY_FORMAT:
+        return game.get_payload("boardState/binary",
+                                lambda board: pack_board(board.epoch, board.sequence, board.tiles))
+    if wire_format == LEGACY_FORMAT:
+        return game.get_payload("boardState/legacy", lambda board: dumps(encode_board(board.tiles)))
+
+    return game.get_payload("boardState", lambda board: dumps({
+        "epoch": board.epoch,
+        "sequence": board.sequence,
+        "tiles": encode_board(board.tiles)
+    }))
+
+
+def export_pinned_tiles(game):
+    return game.get_payload("pinnedTiles", lambda board: board.export_pinned_tiles())
+
+
+def update_pinned(client, game):
+    # Tiles which cannot be picked up without breaking the hive, so clients can grey them out.
+    sio.emit("pinnedTiles", export_pinned_tiles(game), to=client.sid)
 
 
 @sio.on("leave")
 def on_leave(data):
     room = data.get("room")
+    cluster.dispatch(room, leave_game, current_client(), room, data.get("username"))
 
-    username = data.get("username")
 
-    system_chat("%s left the room." % username, room=room)
+@cluster.handler
+def leave_game(client, room, username):
+    try:
+        system_chat("%s left the room." % username, room)
 
-    if games[room].get_player(username) is not None:
-        games[room] = Board()
-        system_chat(
-            "Because %s has left the room, game has been reset. Please rejoin the room to start a new game." % username,
-            room=room)
-    else:
-        games[room].remove_player(username)
+        game = rooms.get(room)
+        if game is None:
+            return
 
-    update_userlist(room)
-    leave_room(room)
+        if game.get_player(username) is not None:
+            pool.cancel(room)
+            game_service.finish_game(game)
+            rooms[room] = Board()
+            system_chat(
+                "Because %s has left the room, game has been reset. Please rejoin the room to start a new game."
+                % username, room)
+        else:
+            game.remove_player(username)
+
+        update_userlist(room)
+    finally:
+        # The client leaves after it was told, this can run on another node than the one it is connected to.
+        leave_room(format_room(room, client.wire_format), sid=client.sid, namespace="/")
+        leave_room(room, sid=client.sid, namespace="/")
 
 
 @sio.on("getBoard")
 def on_get_board(request):
     room = request.get("room")
-    update_board(room, to_room=False)
+    cluster.dispatch(room, update_board, current_client(), room, request.get("epoch"), request.get("sequence"))
 
 
 @sio.on("placeTile")
 def on_place_tile(request):
+    cluster.dispatch(request.get("room"), place_tile, current_client(), request)
+
+
+@cluster.handler
+def place_tile(client, request):
     """
         Assume data to be formatted as follows;
 
@@ -133,109 +242,345 @@ def on_place_tile(request):
     room = request.get("room")
     username = request.get("username")
     data = request.get("data")
-    game = games[room]
+    game = rooms.get(room)
+    if game is None:
+        return
 
     # Dont allow moves if the game has finished.
     if game.winner is not None:
-        system_chat("The game has already finished.")
+        system_chat("The game has already finished.", client.sid)
         return
 
     if len(game.players) < game.max_players:
-        system_chat("Game is not yet ready to start.")
+        system_chat("Game is not yet ready to start.", client.sid)
         return
 
     user = game.get_player(username)
     if not game.is_turn(user):
-        system_chat("It is not yet your turn.")
+        system_chat("It is not yet your turn.", client.sid)
         return
 
     if game.move(user, data):
-        x = int(data.get("new_x"))
-        y = int(data.get("new_y"))
-
-        tile = game.get_tile(x, y)
-        response = {
-            "username": username,
-            "data": {
-                "x": tile.x,
-                "y": tile.y,
-                "z": tile.z,
-                "image": data.get("image")
-            }
+        # After a reset the new game waits for the players again.
+        if broadcast_move(game, room, username, data):
+            return
+
+        if is_cpu_room(room) and game.get_turn().user.name == CPU_NAME:
+            sio.start_background_task(do_cpu_move, game, game.get_turn(), room)
+
+
+def broadcast_move(game, room, username, data) -> bool:
+    """
+    Sends a move which has been made to everybody in the room, and resets the game if it has finished.
+    This uses the server to emit, so it also works outside of a request for CPU moves.
+
+    :return: whether the move finished the game, which has been reset.
+    """
+    x = int(data.get("new_x"))
+    y = int(data.get("new_y"))
+
+    tile = game.get_tile(x, y)
+    response = {
+        "username": username,
+        "data": {
+            "x": tile.x,
+            "y": tile.y,
+            "z": tile.z,
+            "image": data.get("image")
         }
+    }
 
-        emit("placeTile", response, json=True, room=room, include_self=True)
-        # Update userlist with new active player turn.
-        update_userlist(room)
+    game_service.record_move(game, room, username, data)
 
-        if game.finished():
-            emit("finished", {"winner": game.winner, "loser": game.loser}, json=True, room=room, include_self=True)
+    emit_encoded("placeTile", response, pack_place_tile(username, tile.x, tile.y, tile.z, tile.type), room)
+    sio.emit("pinnedTiles", export_pinned_tiles(game), room=room)
+    # Update userlist with new active player turn.
+    sio.emit("userList", game.get_player_list(), room=room)
 
-            user_service.award_elo(game.winner, game.loser)
+    if game.finished():
+        sio.emit("finished", {"winner": game.winner, "loser": game.loser, "draw": game.draw}, room=room)
 
-            system_chat("%s has won! Resetting the game." % game.winner, room=room)
-            game.reset_game()
+        # The ratings are stored in the background, the players see their new ratings once they are.
+        def ratings_stored():
+            cluster.actors.submit(room, refresh_ratings, room)
 
-            update_board(room, to_room=True)
-            update_userlist(room)
+        if game.draw:
+            first, second = (player.user.name for player in game.players)
+            if not is_cpu_room(room):
+                user_service.award_elo(first, second, draw=True, committed=ratings_stored)
+            message = "Both queens are surrounded, the game is a draw! Resetting the game."
         else:
-            if "CPU" in room:
-                cpu = game.get_turn()
-                _thread.start_new_thread(do_cpu_move, (game, cpu, room))
+            if not is_cpu_room(room):
+                user_service.award_elo(game.winner, game.loser, committed=ratings_stored)
+            message = "%s has won! Resetting the game." % game.winner
+
+        system_chat(message, room)
+        pool.cancel(room)
+        game_service.finish_game(game)
+        game.reset_game()
+        broadcast_board(game, room)
+        return True
+
+    return False
+
+
+def refresh_ratings(room):
+    # Ratings change at the end of a game, users which are not stored in the database (such as the CPU) are kept.
+    game = rooms.peek(room)
+    if game is None:
+        return
+
+    for player in game.players:
+        if player.user.name == CPU_NAME:
+            continue
+
+        user = user_service.get_cached_user(name=player.user.name)
+        if user is not None:
+            player.user = user
+
+    sio.emit("userList", game.get_player_list(), room=room)
+
+
+def broadcast_board(game, room):
+    # Sends the whole board to everybody in the room, after a change which is not a single move.
+    emit_encoded("boardState", export_board_state(game), export_board_state(game, BINARY_FORMAT), room,
+                 export_board_state(game, LEGACY_FORMAT))
+    sio.emit("pinnedTiles", export_pinned_tiles(game), room=room)
+    sio.emit("userList", game.get_player_list(), room=room)
+
+
+def restore_games():
+    """
+    Restores the games which were still being played when the server stopped.
+    """
+    # Only the rooms owned by this node are kept here, games idle for longer than rooms are kept were abandoned.
+    games = game_service.load_games(max_idle=rooms.idle_timeout)
+    restored = dict((room, game) for room, game in games.items() if cluster.owns(room))
+    rooms.update(restored)
+
+    for room, game in restored.items():
+        resume_game(room, game)
+
+    print("Restored %d games." % len(restored))
+
+
+def resume_game(room, game):
+    """
+    Continues a game which was restored or read back after eviction.
+
+    :param room:
+    :param game:
+    """
+    # Nobody else will make the CPU move, so continue the game where it was left.
+    if is_cpu_room(room) and len(game.players) == game.max_players and game.get_turn().user.name == CPU_NAME:
+        sio.start_background_task(do_cpu_move, game, game.get_turn(), room)
+
+
+def evict_game(room, game):
+    # A CPU move for an evicted game would be thrown away, it is made again once the game is read back.
+    pool.cancel(room)
+
+
+rooms.on_load = resume_game
+rooms.on_evict = evict_game
+# Games are evicted between the events of their room.
+rooms.submit = cluster.actors.submit
+
+
+def reject_event(room, function, sender):
+    system_chat("The server is too busy to handle that right now, please try again.", sender)
+
+
+cluster.actors.on_rejected = reject_event
+
+
+def is_cpu_room(room):
+    return "CPU" in room
+
+
+def make_cpu_user():
+    # The CPU is not stored in the database, so it does not get a rating.
+    return DetachedUser(CPU_NAME)
+
+
+cpu_max_depth = DEFAULT_CPU_MAX_DEPTH
+cpu_time_limit = DEFAULT_CPU_TIME_LIMIT
+
+
+def init_cpu(max_depth, time_limit):
+    """
+    Configures the search of the CPU opponent.
+
+    :param max_depth: the most moves the CPU looks ahead.
+    :param time_limit: the most seconds the CPU searches for a move.
+    """
+    global cpu_max_depth
+    global cpu_time_limit
+
+    cpu_max_depth = max_depth
+    cpu_time_limit = time_limit
 
 
 def do_cpu_move(game, cpu, room):
-    # move = select_move(game, cpu)
-    # game.move(cpu, move)
-    pass
+    # Search in a worker process, so the other rooms keep running in the meantime.
+    snapshot = game.snapshot()
+    try:
+        move = pool.run(search_snapshot, snapshot, cpu_max_depth, cpu_time_limit,
+                        group=room, timeout=cpu_time_limit + CPU_GRACE_TIME)
+    except JobCancelled:
+        return
+    except (JobTimeout, WorkerError) as e:
+        # The CPU still has to move, make_cpu_move falls back to a legal move.
+        print("CPU move in room %s failed: %s" % (room, e))
+        move = None
+
+    # The move changes the game like the events of the players do, so it waits for its turn in the room.
+    cluster.actors.submit(room, make_cpu_move, game, cpu, room, snapshot.hash, move)
+
+
+def make_cpu_move(game, cpu, room, position, move):
+    """
+    Plays the move the CPU found. Without a move, or when the board rejects it, the first legal move is played
+    instead, so the game does not wait for a CPU move which never comes.
+
+    :param game:
+    :param cpu: the player of the CPU.
+    :param room:
+    :param position: the hash of the board the move was searched on.
+    :param move: the data of a placeTile request, or None if the search failed.
+    """
+    # The game could have been reset or replaced during the search.
+    if rooms.peek(room) is not game or game.hash != position or not game.is_turn(cpu):
+        return
+
+    if move is None or not game.move(cpu, move):
+        if move is not None:
+            print("CPU move %s in room %s was rejected." % (move, room))
+
+        moves = game.get_legal_moves(cpu)
+        if not moves:
+            return
+        move = export_move(game, moves[0])
+        if not game.move(cpu, move):
+            print("CPU move %s in room %s was rejected." % (move, room))
+            return
+
+    broadcast_move(game, room, cpu.user.name, move)
 
 
 @sio.on("pickupTile")
 def on_pickup_tile(request):
+    cluster.dispatch(request.get("room"), pickup_tile, current_client(), request)
+
+
+@cluster.handler
+def pickup_tile(client, request):
     room = request.get("room")
     username = request.get("username")
     data = request.get("data")
 
-    game = games[room]
+    game = rooms.get(room)
+    if game is None:
+        return
 
     # Dont allow moves if the game has finished.
     if game.winner is not None:
-        system_chat("The game has already finished.")
+        system_chat("The game has already finished.", client.sid)
         return
 
     user = game.get_player(username)
     if not game.is_turn(user):
-        system_chat("It is not yet your turn.")
+        system_chat("It is not yet your turn.", client.sid)
         return
 
     x = int(data.get("x"))
     y = int(data.get("y"))
     tile = game.get_tile(x, y)
     if tile is None:
-        system_chat("There is no tile on (%d, %d) to pick up." % (x, y))
+        system_chat("There is no tile on (%d, %d) to pick up." % (x, y), client.sid)
         return
 
     if game.breaks_hive(tile):
-        system_chat("This move would break the hive.")
+        system_chat("This move would break the hive.", client.sid)
         return
 
     # Send available tiles
-    markings = json.dumps(list(game.export_valid_moves(x, y, user)), cls=ObjectEncoder)
-    emit("markedTiles", markings, json=True, include_self=True)
-    emit("pickupTile", request, json=True, room=room, include_self=True)
+    moves = game.export_valid_moves(x, y, user)
+    if client.wire_format == BINARY_FORMAT:
+        markings = pack_moves(moves)
+    else:
+        markings = dumps(encode_moves(moves))
+    sio.emit("markedTiles", markings, to=client.sid)
+    sio.emit("pickupTile", request, room=room)
+
+
+@sio.on("takeback")
+def on_takeback(request):
+    cluster.dispatch(request.get("room"), takeback_move, current_client(), request)
+
+
+@cluster.handler
+def takeback_move(client, request):
+    """
+    Takes back the last move of the player, as long as the other player has not moved since.
+    In CPU rooms the answer of the CPU is taken back as well.
+    """
+    room = request.get("room")
+    username = request.get("username")
+
+    game = rooms.get(room)
+    if game is None:
+        return
+
+    player = game.get_player(username)
+    if player is None:
+        return
+
+    amount = 1
+    last_mover = game.get_last_mover()
+    if is_cpu_room(room) and last_mover is not None and last_mover.user.name == CPU_NAME:
+        amount = 2
+
+    if game.get_last_mover(amount - 1) is not player:
+        system_chat("There is no move of yours to take back.", client.sid)
+        return
+
+    # The CPU could still be searching for its answer to the move.
+    pool.cancel(room)
+    for _ in range(amount):
+        mover = game.takeback()
+        game_service.record_move(game, room, mover.user.name, {"takeback": True})
+
+    broadcast_board(game, room)
+    sio.emit("tileAmounts", player.get_tile_amounts(), to=client.sid)
+    system_chat("%s took back their last move." % username, room)
 
 
 @sio.on("mouseHover")
 def on_mouse_hover(data):
+    # Only the latest hover of a player is forwarded, at most hovers.rate times a second.
+    hovers.add(data.get("room"), data.get("username"), (current_client(), data))
+
+
+def send_hover(room, username, hover):
+    client, data = hover
+    cluster.dispatch(room, mouse_hover, client, data)
+
+
+hovers = HoverCoalescer(send_hover)
+
+
+@cluster.handler
+@droppable
+def mouse_hover(client, data):
     room = data.get("room")
-    username = data.get("username")
 
-    game = games[room]
+    game = rooms.get(room)
+    if game is None:
+        return
 
-    for player in game.players:
-        if player.user.name == username:
-            emit("mouseHover", data, json=True, room=room, include_self=False)
-            return
+    if game.get_player(data.get("username")) is not None:
+        sio.emit("mouseHover", data, room=room, skip_sid=client.sid)
 
 
 @sio.on("chatMessage")
@@ -0,0 +1,85 @@
+#
+# Coalescing of mouseHover events.
+#
+# Players send a hover event for every mouse movement, but only the latest position matters to the others.
+# Hovers are collected per room and player, and sent on every tick, RATE times a second at most.
+# A hover which is replaced by a newer one before the tick is dropped.
+#
+import time
+
+import gevent
+from gevent.event import Event
+
+DEFAULT_RATE = 20
+
+# Seconds between two reports of the amount of hovers sent and dropped.
+REPORT_INTERVAL = 60
+
+
+class HoverCoalescer:
+    def __init__(self, send, rate=DEFAULT_RATE):
+        """
+        :param send: called with the room, username and the latest hover of the player on every tick.
+        :param rate: ticks per second.
+        """
+        self.send = send
+        self.rate = rate
+
+        # The latest hover by room and username.
+        self._pending = {}
+        self._waiting = Event()
+        self._flusher = None
+
+        self.sent = 0
+        self.coalesced = 0
+        self._reported = time.monotonic()
+
+    def add(self, room, username, hover):
+        """
+        Queues a hover of a player to be sent on the next tick, replacing the one still queued.
+
+        :param room:
+        :param username:
+        :param hover:
+        """
+        players = self._pending.setdefault(room, {})
+        if username in players:
+            self.coalesced += 1
+        players[username] = hover
+
+        self._waiting.set()
+        if self._flusher is None:
+            self._flusher = gevent.spawn(self._flush_loop)
+
+    def flush(self):
+        """
+        Sends the queued hovers right away.
+        """
+        pending, self._pending = self._pending, {}
+        for room, players in pending.items():
+            for username, hover in players.items():
+                self.sent += 1
+                try:
+                    self.send(room, username, hover)
+                except Exception as e:
+                    print("Sending the hover of %s in room %s failed: %s" % (username, room, e))
+
+    def _flush_loop(self):
+        while True:
+            # Nothing to do until the next hover arrives.
+            self._waiting.wait()
+            self._waiting.clear()
+
+            gevent.sleep(1 / self.rate)
+            self.flush()
+            self._report()
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._reported < REPORT_INTERVAL:
+            return
+
+        print("Sent %d hovers, dropped %d superseded ones." % (self.sent, self.coalesced))
+        self.sent = 0
+        self.coalesced = 0
+        self._reported = now
@@ -0,0 +1,118 @@
+#
+# Finding an opponent of a similar rating.
+#
+# The queue of waiting players lives on the node owning the MATCHMAKING key, where its events run one at a time like
+# the events of a room. Paired players get a new room, which is set up with both of them seated on the node owning
+# it, after which both are sent a matchFound event to join it.
+#
+import random
+import uuid
+
+import gevent
+from flask import request, session
+
+from project.cluster import cluster
+from project.database import user_service
+from project.game_socket.game import Client, current_client
+from project.manage import sio
+from project.matchmaking import matchmaker
+from project.rooms import rooms
+from project.session import session_user
+
+# The key deciding which node runs the queue.
+MATCHMAKING = "matchmaking"
+
+# Seconds between two attempts at pairing the players which are waiting.
+PAIR_INTERVAL = 1
+
+_pairing = None
+
+
+@sio.on("findMatch")
+def on_find_match(data=None):
+    user = session_user()
+    if user is None:
+        return
+
+    cluster.dispatch(MATCHMAKING, queue_player, current_client(), user.id, user.name, user.elo)
+
+
+@sio.on("cancelMatch")
+def on_cancel_match(data=None):
+    user = session_user()
+    if user is None:
+        return
+
+    cluster.dispatch(MATCHMAKING, cancel_player, user.name, request.sid)
+
+
+@sio.on("disconnect")
+def on_disconnect(reason=None):
+    # Nobody would join the room of a match found for a player who is gone.
+    if "user_id" not in session:
+        return
+
+    user = session_user()
+    if user is not None:
+        cluster.dispatch(MATCHMAKING, cancel_player, user.name, request.sid)
+
+
+@cluster.handler
+def queue_player(client: Client, user_id, username, elo):
+    match = matchmaker.add(username, user_id, elo, client)
+    if match is not None:
+        start_match(*match)
+        return
+
+    sio.emit("matchQueued", {"waiting": len(matchmaker)}, to=client.sid)
+
+    global _pairing
+    if _pairing is None:
+        _pairing = gevent.spawn(_pair_loop)
+
+
+@cluster.handler
+def cancel_player(username, sid):
+    # Only the connection which asked for the match can cancel it.
+    ticket = matchmaker.get(username)
+    if ticket is not None and ticket.client.sid == sid:
+        matchmaker.remove(username)
+
+
+def pair_waiting():
+    for first, second in matchmaker.pair():
+        start_match(first, second)
+
+
+def _pair_loop():
+    global _pairing
+
+    # Windows widen while players wait, so pairs are looked for again until nobody is waiting.
+    while len(matchmaker):
+        gevent.sleep(PAIR_INTERVAL)
+        cluster.actors.submit(MATCHMAKING, pair_waiting)
+    _pairing = None
+
+
+def start_match(first, second):
+    room = "match-%s" % uuid.uuid4().hex[:12]
+
+    # The player to move first is drawn.
+    players = [(ticket.client, ticket.uid) for ticket in (first, second)]
+    random.shuffle(players)
+    cluster.dispatch(room, seat_players, room, players)
+
+
+@cluster.handler
+def seat_players(room, players):
+    users = [user_service.get_cached_user(uid=user_id) for _, user_id in players]
+    if None in users:
+        return
+
+    game = rooms.create(room)
+    for user in users:
+        game.add_player(user)
+
+    # The players are told about the match once they have their seats, joining the room sends them the board.
+    for client, _ in players:
+        sio.emit("matchFound", {"room": room}, to=client.sid)
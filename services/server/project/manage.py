@@ -33,7 +33,34 @@ def write_config_sample():
     config["app"]["port"] = "5001"
     config["app"]["debug"] = "true"
     config["app"]["secret"] = str(os.urandom(24))
+    config["database"] = {}
     config["database"]["url"] = "sqlite:///storage/database.db"
+    config["database"]["pool_size"] = "5"
+    config["database"]["max_overflow"] = "10"
+    config["database"]["pool_timeout"] = "30"
+    config["database"]["pool_recycle"] = "3600"
+    config["database"]["pool_pre_ping"] = "true"
+    config["database"]["sqlite_synchronous"] = "NORMAL"
+    config["auth"] = {}
+    config["auth"]["threads"] = "2"
+    config["auth"]["bcrypt_rounds"] = "12"
+    config["auth"]["max_pending"] = "32"
+    config["matchmaking"] = {}
+    config["matchmaking"]["bucket_width"] = "50"
+    config["matchmaking"]["window"] = "100"
+    config["matchmaking"]["widen_rate"] = "10"
+    config["matchmaking"]["max_window"] = "800"
+    config["workers"] = {}
+    config["workers"]["processes"] = "2"
+    config["cpu"] = {}
+    config["cpu"]["max_depth"] = "3"
+    config["cpu"]["time_limit"] = "1.0"
+    config["rooms"] = {}
+    config["rooms"]["max_rooms"] = "1000"
+    config["rooms"]["idle_timeout"] = "3600"
+    config["rooms"]["directory"] = "storage/rooms"
+    config["rooms"]["hover_rate"] = "20"
+    config["rooms"]["max_pending"] = "256"
 
     with open("config.ini", "w+") as f:
         config.write(f)
@@ -52,7 +79,14 @@ def init():
         sys.exit(1)
 
     app = create_app(config_parser)
-    sio = SocketIO(app, async_mode='gevent', manage_session=True)
+
+    # With a [cluster] section, rooms are spread over several server processes which share a message queue.
+    import project.cluster
+    options = {}
+    client_manager = project.cluster.init_cluster(config_parser)
+    if client_manager is not None:
+        options["client_manager"] = client_manager
+    sio = SocketIO(app, async_mode='gevent', manage_session=True, **options)
 
     CORS(app)
 
@@ -70,11 +104,65 @@ def init():
     import project.database
     project.database.register_teardown(app)
     print("Attempting to connect to", app.config["database_url"])
-    project.database.init_db(app.config["database_url"])
+    # Pool settings which are not configured use the defaults of project.database.pool.
+    project.database.init_db(app.config["database_url"],
+                             pool_size=config_parser.getint("database", "pool_size", fallback=None),
+                             max_overflow=config_parser.getint("database", "max_overflow", fallback=None),
+                             pool_timeout=config_parser.getint("database", "pool_timeout", fallback=None),
+                             pool_recycle=config_parser.getint("database", "pool_recycle", fallback=None),
+                             pool_pre_ping=config_parser.getboolean("database", "pool_pre_ping", fallback=True),
+                             sqlite_synchronous=config_parser.get("database", "sqlite_synchronous", fallback=None))
 
     # Create model
     project.database.metadata_create_all()
 
+    # Hash passwords in native threads, so logins do not stop the games.
+    import project.passwords
+    project.passwords.init_passwords(
+        config_parser.getint("auth", "threads", fallback=project.passwords.DEFAULT_THREADS),
+        config_parser.getint("auth", "bcrypt_rounds", fallback=project.passwords.DEFAULT_ROUNDS),
+        config_parser.getint("auth", "max_pending", fallback=project.passwords.DEFAULT_MAX_PENDING))
+
+    # Start the processes for CPU heavy game computations.
+    import project.workers
+    project.workers.init_workers(config_parser.getint("workers", "processes", fallback=2))
+
+    # Keep the games of active rooms in memory, and move idle ones to disk.
+    import project.rooms
+    project.rooms.init_rooms(config_parser.getint("rooms", "max_rooms", fallback=project.rooms.DEFAULT_MAX_ROOMS),
+                             config_parser.getint("rooms", "idle_timeout",
+                                                  fallback=project.rooms.DEFAULT_IDLE_TIMEOUT),
+                             config_parser.get("rooms", "directory", fallback=project.rooms.DEFAULT_DIRECTORY),
+                             project.cluster.cluster.node)
+
+    # Mouse hovers are sent to the room on a fixed tick.
+    project.game_socket.game.hovers.rate = config_parser.getint("rooms", "hover_rate",
+                                                               fallback=project.game_socket.hover.DEFAULT_RATE)
+
+    # How far and how long the CPU opponent searches for its moves.
+    project.game_socket.game.init_cpu(
+        config_parser.getint("cpu", "max_depth", fallback=project.game_socket.game.DEFAULT_CPU_MAX_DEPTH),
+        config_parser.getfloat("cpu", "time_limit", fallback=project.game_socket.game.DEFAULT_CPU_TIME_LIMIT))
+
+    # Pair waiting players of similar ratings, accepting larger differences the longer they wait.
+    import project.matchmaking
+    project.matchmaking.init_matchmaking(
+        config_parser.getint("matchmaking", "bucket_width", fallback=project.matchmaking.DEFAULT_BUCKET_WIDTH),
+        config_parser.getint("matchmaking", "window", fallback=project.matchmaking.DEFAULT_WINDOW),
+        config_parser.getint("matchmaking", "widen_rate", fallback=project.matchmaking.DEFAULT_WIDEN_RATE),
+        config_parser.getint("matchmaking", "max_window", fallback=project.matchmaking.DEFAULT_MAX_WINDOW))
+
+    # Handle the game events of the rooms owned by this node, also those other nodes forward.
+    project.cluster.cluster.actors.max_pending = config_parser.getint(
+        "rooms", "max_pending", fallback=project.actors.DEFAULT_MAX_PENDING)
+    project.cluster.cluster.start(app)
+
+    # Store games and ratings in the background, and continue the games which were running before the server stopped.
+    from project.database import writer
+    writer.start_writer()
+    import project.game_socket.game
+    project.game_socket.game.restore_games()
+
     print("Done initializing.")
 
 
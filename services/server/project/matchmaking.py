@@ -0,0 +1,283 @@
+#
+# Queue of players looking for an opponent.
+#
+# Waiting players are indexed by rating in buckets of bucket_width points, the buckets which have players are kept
+# sorted. A player is paired with somebody within its window: window points above or below its own rating, growing by
+# widen_rate points for every second it waits, up to max_window. The nearest bucket is searched first, and within a
+# bucket the player who waited longest is chosen, so finding an opponent takes a binary search over the buckets.
+#
+# A player who finds nobody is due again once its window reaches the nearest rating in the queue. Waiting players are
+# only searched for again when they are due, and a new player makes the players with the closest ratings due sooner
+# if it is nearer to them.
+#
+import bisect
+import heapq
+import time
+from typing import List, Optional, Tuple
+
+DEFAULT_BUCKET_WIDTH = 50
+DEFAULT_WINDOW = 100
+DEFAULT_WIDEN_RATE = 10
+DEFAULT_MAX_WINDOW = 800
+
+
+class Ticket:
+    """
+    A player waiting for an opponent.
+    """
+    __slots__ = ("name", "uid", "elo", "client", "queued", "order", "bucket", "due")
+
+    def __init__(self, name, uid, elo, client, queued, order, bucket):
+        self.name = name
+        self.uid = uid
+        self.elo = elo
+        # Whatever is needed to tell the player about the match.
+        self.client = client
+        # When the player started waiting, players who started at the same time are ordered by when they came.
+        self.queued = queued
+        self.order = order
+        self.bucket = bucket
+        # The time.monotonic() at which the window reaches the nearest rating, None if it never will.
+        self.due = None
+
+
+class Matchmaker:
+    def __init__(self, bucket_width=DEFAULT_BUCKET_WIDTH, window=DEFAULT_WINDOW, widen_rate=DEFAULT_WIDEN_RATE,
+                 max_window=DEFAULT_MAX_WINDOW):
+        self.bucket_width = bucket_width
+        self.window = window
+        self.widen_rate = widen_rate
+        self.max_window = max_window
+
+        # Lists of (queued, order, ticket) by bucket, longest waiting first.
+        self._buckets = {}
+        # The buckets which have tickets, sorted.
+        self._keys = []
+        # Tickets by name.
+        self._tickets = {}
+        # (due, name) of the tickets to search for again, entries of tickets which are gone or rescheduled are skipped.
+        self._due = []
+        self._queued = 0
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def __contains__(self, name):
+        return name in self._tickets
+
+    def add(self, name, uid, elo, client, now=None) -> Optional[Tuple[Ticket, Ticket]]:
+        """
+        Pairs a player with a waiting opponent, or queues the player if there is none.
+        A player who was already waiting is queued again, keeping the time it has waited.
+
+        :param name:
+        :param uid:
+        :param elo:
+        :param client:
+        :param now: the current time.monotonic().
+        :return: the opponent and the ticket of the player if they are paired, None if the player is waiting.
+        """
+        now = time.monotonic() if now is None else now
+
+        previous = self.remove(name)
+        if previous is None:
+            self._queued += 1
+            ticket = Ticket(name, uid, elo, client, now, self._queued, self._bucket(elo))
+        else:
+            ticket = Ticket(name, uid, elo, client, previous.queued, previous.order, self._bucket(elo))
+
+        opponent = self._find(ticket, now)
+        if opponent is not None:
+            self.remove(opponent.name)
+            return opponent, ticket
+
+        self._tickets[name] = ticket
+        bucket = self._buckets.get(ticket.bucket)
+        if bucket is None:
+            bucket = self._buckets[ticket.bucket] = []
+            bisect.insort(self._keys, ticket.bucket)
+        bisect.insort(bucket, (ticket.queued, ticket.order, ticket))
+
+        self._schedule(ticket, self._get_nearest(ticket))
+        # The players with the closest ratings may reach this one before the rating they were due for.
+        for other in self._get_neighbours(ticket):
+            self._schedule(other, abs(other.elo - ticket.elo), sooner=True)
+        return None
+
+    def remove(self, name) -> Optional[Ticket]:
+        """
+        Stops looking for an opponent for a player.
+
+        :param name:
+        :return: the ticket of the player, or None if it was not waiting.
+        """
+        ticket = self._tickets.pop(name, None)
+        if ticket is None:
+            return None
+
+        bucket = self._buckets[ticket.bucket]
+        del bucket[bisect.bisect_left(bucket, (ticket.queued, ticket.order))]
+        if not bucket:
+            del self._buckets[ticket.bucket]
+            del self._keys[bisect.bisect_left(self._keys, ticket.bucket)]
+        return ticket
+
+    def get(self, name) -> Optional[Ticket]:
+        return self._tickets.get(name)
+
+    def pair(self, now=None) -> List[Tuple[Ticket, Ticket]]:
+        """
+        Pairs the waiting players whose windows have grown enough to find an opponent, longest waiting first.
+        Only the players who are due are searched for.
+
+        :param now: the current time.monotonic().
+        :return: the pairs, which are no longer waiting.
+        """
+        now = time.monotonic() if now is None else now
+
+        due = []
+        while self._due and self._due[0][0] <= now:
+            at, name = heapq.heappop(self._due)
+            ticket = self._tickets.get(name)
+            if ticket is not None and ticket.due == at:
+                ticket.due = None
+                due.append(ticket)
+        due.sort(key=lambda ticket: (ticket.queued, ticket.order))
+
+        pairs = []
+        for ticket in due:
+            # Already paired with a player who waited longer.
+            if ticket.name not in self._tickets:
+                continue
+
+            opponent = self._find(ticket, now)
+            if opponent is not None:
+                self.remove(ticket.name)
+                self.remove(opponent.name)
+                pairs.append((ticket, opponent))
+            else:
+                # The player it was due for is gone.
+                self._schedule(ticket, self._get_nearest(ticket))
+        return pairs
+
+    def get_window(self, ticket, now) -> float:
+        """
+        The most rating points an opponent of the player can differ.
+
+        :param ticket:
+        :param now: the current time.monotonic().
+        :return:
+        """
+        return min(self.max_window, self.window + self.widen_rate * (now - ticket.queued))
+
+    def _bucket(self, elo) -> int:
+        return int(elo // self.bucket_width)
+
+    def _schedule(self, ticket, distance, sooner=False):
+        """
+        Makes the player due once its window reaches the given amount of rating points.
+
+        :param ticket:
+        :param distance: the rating points, None if there is nobody to reach.
+        :param sooner: only change when the player is due if it becomes sooner.
+        """
+        due = None
+        if distance is not None and distance <= self.max_window:
+            if distance <= self.window:
+                due = ticket.queued
+            elif self.widen_rate > 0:
+                due = ticket.queued + (distance - self.window) / self.widen_rate
+
+        if due is None or (sooner and ticket.due is not None and ticket.due <= due):
+            if not sooner:
+                ticket.due = None
+            return
+
+        ticket.due = due
+        heapq.heappush(self._due, (due, ticket.name))
+
+    def _get_nearest(self, ticket) -> Optional[float]:
+        """
+        The least rating points between the player and another waiting player.
+
+        :param ticket:
+        :return: None if nobody else is waiting.
+        """
+        keys = self._keys
+        width = self.bucket_width
+        nearest = None
+
+        right = bisect.bisect_left(keys, ticket.bucket)
+        left = right - 1
+        while left >= 0 or right < len(keys):
+            # The least difference with a rating in the next bucket on either side.
+            below = ticket.elo - (keys[left] + 1) * width if left >= 0 else None
+            above = keys[right] * width - ticket.elo if right < len(keys) else None
+            if above is None or (below is not None and below < above):
+                bound, key = below, keys[left]
+                left -= 1
+            else:
+                bound, key = above, keys[right]
+                right += 1
+
+            if nearest is not None and bound >= nearest:
+                break
+
+            for _, _, other in self._buckets[key]:
+                if other is not ticket:
+                    distance = abs(other.elo - ticket.elo)
+                    if nearest is None or distance < nearest:
+                        nearest = distance
+        return nearest
+
+    def _get_neighbours(self, ticket):
+        """
+        The other players in the bucket of the player and in the nearest buckets below and above it, every waiting
+        player who has nobody with a rating between its own and the rating of the player is one of them.
+        """
+        index = bisect.bisect_left(self._keys, ticket.bucket)
+        for key in self._keys[max(index - 1, 0):index + 2]:
+            for _, _, other in self._buckets[key]:
+                if other is not ticket:
+                    yield other
+
+    def _find(self, ticket, now) -> Optional[Ticket]:
+        window = self.get_window(ticket, now)
+        keys = self._keys
+
+        # The buckets within the window, from the one nearest to the rating of the player outwards.
+        low = bisect.bisect_left(keys, self._bucket(ticket.elo - window))
+        high = bisect.bisect_right(keys, self._bucket(ticket.elo + window))
+        right = bisect.bisect_left(keys, ticket.bucket, low, high)
+        left = right - 1
+
+        while left >= low or right < high:
+            if right >= high or (left >= low and ticket.bucket - keys[left] < keys[right] - ticket.bucket):
+                key = keys[left]
+                left -= 1
+            else:
+                key = keys[right]
+                right += 1
+
+            for _, _, opponent in self._buckets[key]:
+                if opponent.name != ticket.name and abs(opponent.elo - ticket.elo) <= window:
+                    return opponent
+        return None
+
+
+matchmaker = Matchmaker()
+
+
+def init_matchmaking(bucket_width, window, widen_rate, max_window):
+    """
+    Configures how far apart the ratings of paired players can be.
+
+    :param bucket_width: rating points per bucket of the index.
+    :param window: rating points an opponent can differ at first.
+    :param widen_rate: rating points the window grows by for every second a player waits.
+    :param max_window: the most rating points an opponent can differ.
+    """
+    matchmaker.bucket_width = bucket_width
+    matchmaker.window = window
+    matchmaker.widen_rate = widen_rate
+    matchmaker.max_window = max_window
@@ -0,0 +1,105 @@
+#
+# Hashing and checking of passwords.
+#
+# bcrypt is slow on purpose, and running it on the event loop would stop every game for the time it takes.
+# Passwords are hashed in a pool of native threads instead, and the greenlet waiting for the result lets the other
+# greenlets run. At most max_pending passwords wait for a free thread, more are rejected, so a burst of logins cannot
+# pile up without bound.
+#
+import time
+
+import bcrypt
+from gevent.threadpool import ThreadPool
+
+DEFAULT_THREADS = 2
+DEFAULT_ROUNDS = 12
+DEFAULT_MAX_PENDING = 32
+
+# Seconds between two reports of the time logins and registrations spent on passwords.
+REPORT_INTERVAL = 60
+
+
+class PasswordsBusy(Exception):
+    """
+    Raised when too many passwords are waiting to be hashed or checked.
+    """
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, threads=DEFAULT_THREADS, rounds=DEFAULT_ROUNDS, max_pending=DEFAULT_MAX_PENDING):
+        """
+        :param threads: the amount of passwords hashed at the same time.
+        :param rounds: the bcrypt cost factor of new hashes, every round doubles the time hashing takes.
+        :param max_pending: the most passwords waiting for a thread.
+        """
+        self.threads = threads
+        self.rounds = rounds
+        self.max_pending = max_pending
+
+        self._pool = None
+        # Passwords being hashed or waiting for a thread.
+        self._pending = 0
+
+        self.done = 0
+        self.rejected = 0
+        # Seconds from queueing a password until it was hashed, in total and the longest.
+        self.waited = 0.0
+        self.longest_wait = 0.0
+        self._reported = time.monotonic()
+
+    def hash(self, password: str) -> bytes:
+        return self._run(bcrypt.hashpw, password.encode(), bcrypt.gensalt(self.rounds))
+
+    def check(self, password: str, hashed: bytes) -> bool:
+        return self._run(bcrypt.checkpw, password.encode(), hashed)
+
+    def _run(self, function, *args):
+        if self._pending >= self.threads + self.max_pending:
+            self.rejected += 1
+            raise PasswordsBusy()
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+
+        self._pending += 1
+        start = time.monotonic()
+        try:
+            return self._pool.apply(function, args)
+        finally:
+            self._pending -= 1
+
+            waited = time.monotonic() - start
+            self.done += 1
+            self.waited += waited
+            self.longest_wait = max(self.longest_wait, waited)
+            self._report()
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._reported < REPORT_INTERVAL:
+            return
+
+        print("Hashed %d passwords in %.1f ms on average and %.1f ms at most, rejected %d."
+              % (self.done, self.waited / self.done * 1000, self.longest_wait * 1000, self.rejected))
+        self.done = 0
+        self.rejected = 0
+        self.waited = 0.0
+        self.longest_wait = 0.0
+        self._reported = now
+
+
+passwords = PasswordHasher()
+
+
+def init_passwords(threads, rounds, max_pending):
+    """
+    Configures the threads hashing passwords.
+
+    :param threads: the amount of passwords hashed at the same time.
+    :param rounds: the bcrypt cost factor of new hashes.
+    :param max_pending: the most passwords waiting for a thread, before logins are rejected.
+    """
+    passwords.threads = threads
+    passwords.rounds = rounds
+    passwords.max_pending = max_pending
@@ -0,0 +1,233 @@
+#
+# Registry of the games being played, by room.
+#
+# Rooms are kept in order of their last activity. When there are more than max_rooms rooms, or a room has not been
+# used for idle_timeout seconds, its game is written to a file in the spill directory and dropped from memory.
+# The game is read back from that file the next time the room is used. Every node of a cluster has its own directory.
+# Evicting waits for the events of the room which are still queued, so nothing changes a game after it was written.
+# When one of those events uses the room, it is not evicted.
+# Looking up a room which has no game does not create one, only create does.
+#
+import hashlib
+import os
+import pickle
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import gevent
+
+from project.game.Board import Board
+
+DEFAULT_MAX_ROOMS = 1000
+DEFAULT_IDLE_TIMEOUT = 3600
+DEFAULT_DIRECTORY = "storage/rooms"
+
+# Most seconds between two checks for idle rooms.
+SWEEP_INTERVAL = 60
+
+
+class RoomRegistry:
+    def __init__(self, max_rooms=DEFAULT_MAX_ROOMS, idle_timeout=DEFAULT_IDLE_TIMEOUT, directory=None):
+        self.max_rooms = max_rooms
+        self.idle_timeout = idle_timeout
+        # Without a directory, evicted games are dropped.
+        self.directory = directory
+
+        # Called with the room and game when a game is read back from its file.
+        self.on_load = None
+        # Called with the room and game when a game is dropped from memory.
+        self.on_evict = None
+        # Called with the room, a function and its arguments to run the function after the queued events of the room.
+        # It returns False if it could not queue the function. Without it, games are evicted right away.
+        self.submit = None
+
+        # Games by room, least recently used first, with the time they were last used.
+        self._games = OrderedDict()
+        # Rooms waiting for their events to finish before being evicted.
+        self._evicting = set()
+        self._sweeper = None
+
+    def get(self, room) -> Optional[Board]:
+        """
+        Returns the game of the room, reading it back if it has been evicted.
+
+        :param room:
+        :return: the game, or None if the room has no game.
+        """
+        entry = self._games.get(room)
+        if entry is not None:
+            self._touch(room, entry[0])
+            return entry[0]
+
+        game = self._load(room)
+        if game is not None:
+            self[room] = game
+            if self.on_load is not None:
+                self.on_load(room, game)
+        return game
+
+    def peek(self, room) -> Optional[Board]:
+        """
+        Returns the game of the room if it is in memory, without counting as activity.
+
+        :param room:
+        :return:
+        """
+        entry = self._games.get(room)
+        return None if entry is None else entry[0]
+
+    def create(self, room) -> Board:
+        """
+        Returns the game of the room, and starts a new game if it does not have one.
+
+        :param room:
+        :return:
+        """
+        game = self.get(room)
+        if game is None:
+            game = self[room] = Board()
+        return game
+
+    def __setitem__(self, room, game):
+        self._touch(room, game)
+        self._evict_over_limit()
+
+    def update(self, games: dict):
+        for room, game in games.items():
+            self[room] = game
+
+    def items(self):
+        return [(room, entry[0]) for room, entry in self._games.items()]
+
+    def __len__(self):
+        return len(self._games)
+
+    def _touch(self, room, game):
+        self._games[room] = (game, time.monotonic())
+        self._games.move_to_end(room)
+
+    def _evict_over_limit(self):
+        excess = len(self._games) - len(self._evicting) - self.max_rooms
+        if excess <= 0:
+            return
+
+        # Least recently used first.
+        rooms = []
+        for room in self._games:
+            if len(rooms) == excess:
+                break
+            if room not in self._evicting:
+                rooms.append(room)
+
+        for room in rooms:
+            self._queue_evict(room)
+
+    def evict_idle(self):
+        """
+        Evicts all games which have not been used for longer than the idle timeout.
+        """
+        deadline = time.monotonic() - self.idle_timeout
+
+        rooms = []
+        for room, (_, last_used) in self._games.items():
+            if last_used > deadline:
+                break
+            if room not in self._evicting:
+                rooms.append(room)
+
+        for room in rooms:
+            self._queue_evict(room)
+
+    def _queue_evict(self, room):
+        if self.submit is None:
+            self._evict(room)
+            return
+
+        self._evicting.add(room)
+        if not self.submit(room, self._evict_unused, room, self._games[room][1]):
+            self._evicting.discard(room)
+
+    def _evict_unused(self, room, last_used):
+        self._evicting.discard(room)
+
+        # The room was used by an event which was queued before, so it is kept.
+        entry = self._games.get(room)
+        if entry is not None and entry[1] == last_used:
+            self._evict(room)
+
+        # Another room has to go instead.
+        self._evict_over_limit()
+
+    def _evict(self, room):
+        game, _ = self._games.pop(room)
+        if self.on_evict is not None:
+            self.on_evict(room, game)
+
+        # A game without players or moves is the same as no game at all.
+        if self.directory is None or (game.sequence == 0 and not game.players):
+            return
+
+        try:
+            with open(self._path(room), "wb") as file:
+                pickle.dump((game.snapshot(), game.epoch, game.sequence), file, pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            print("Could not store the game of room %s: %s" % (room, e))
+
+    def _load(self, room) -> Optional[Board]:
+        if self.directory is None:
+            return None
+
+        path = self._path(room)
+        try:
+            with open(path, "rb") as file:
+                snapshot, epoch, sequence = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        os.unlink(path)
+
+        game = Board.from_snapshot(snapshot)
+        game.epoch = epoch
+        game.sequence = sequence
+        return game
+
+    def _path(self, room):
+        name = hashlib.sha1(str(room).encode()).hexdigest()
+        return os.path.join(self.directory, name + ".pickle")
+
+    def start(self):
+        """
+        Starts evicting idle games in the background.
+        """
+        if self.directory is not None:
+            # Files of a previous run are outdated, the games are restored from the database instead.
+            os.makedirs(self.directory, exist_ok=True)
+            for name in os.listdir(self.directory):
+                if name.endswith(".pickle"):
+                    os.unlink(os.path.join(self.directory, name))
+
+        if self._sweeper is None:
+            self._sweeper = gevent.spawn(self._sweep)
+
+    def _sweep(self):
+        while True:
+            gevent.sleep(min(SWEEP_INTERVAL, self.idle_timeout / 4))
+            self.evict_idle()
+
+
+rooms = RoomRegistry()
+
+
+def init_rooms(max_rooms, idle_timeout, directory, node):
+    """
+    Configures the limits of the room registry and starts evicting idle rooms.
+
+    :param max_rooms: the most games kept in memory.
+    :param idle_timeout: seconds after which an unused game is evicted.
+    :param directory: where evicted games are stored, in a directory per node.
+    :param node: the name of this node in the cluster.
+    """
+    rooms.max_rooms = max_rooms
+    rooms.idle_timeout = idle_timeout
+    rooms.directory = os.path.join(directory, node)
+    rooms.start()
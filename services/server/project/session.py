@@ -1,27 +1,25 @@
 from typing import Optional
 
-from flask import session, g as flaskg
+from flask import session
 
 from project.database import user_service
 from project.database.models import UserModel
+from project.game.Player import DetachedUser
 
 
-def session_user() -> UserModel:
+def session_user() -> Optional[DetachedUser]:
     """
-    Return the currently authenticated user.
-    :return: the currently authenticated user.
+    Return the currently authenticated user, from the user cache so socket events do not query the database.
+    :return: the currently authenticated user, or None if the user no longer exists.
     :raises: ValueError if no user is logged in.
     """
     user_id = session['user_id'] if 'user_id' in session else None
-    print(user_id)
     if user_id is not None:
-        if not hasattr(flaskg, 'session_user'):
-            flaskg.session_user = user_service.get_user(uid=user_id)
+        user = user_service.get_cached_user(uid=user_id)
+        if user is None:
+            del session['user_id']
 
-            if flaskg.session_user is None:
-                del session['user_id']
-
-        return flaskg.session_user
+        return user
     raise ValueError('No user logged in.')
 
 
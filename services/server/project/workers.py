@@ -0,0 +1,179 @@
+#
+# Pool of worker processes for CPU heavy work, such as the CPU player search.
+#
+# Everything on the server runs on a single gevent loop, so long computations stall every room.
+# Jobs are sent to separate processes instead, and the calling greenlet waits on the result without blocking the loop.
+# Functions and arguments must be picklable, e.g. a module level function and a BoardSnapshot.
+#
+import multiprocessing
+import traceback
+from collections import defaultdict
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.queue import Queue
+from gevent.socket import wait_read
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class WorkerError(Exception):
+    pass
+
+
+def _work(jobs, results):
+    """
+    Main loop of a worker process, which runs jobs until the server closes the connection.
+    """
+    while True:
+        try:
+            function, args = jobs.recv()
+        except (EOFError, OSError):
+            return
+
+        try:
+            results.send((True, function(*args)))
+        except Exception:
+            results.send((False, traceback.format_exc()))
+
+
+class _Job:
+    def __init__(self, function, args, group, timeout):
+        self.function = function
+        self.args = args
+        self.group = group
+        self.timeout = timeout
+        self.result = AsyncResult()
+
+
+class WorkerPool:
+    def __init__(self):
+        self._jobs = Queue()
+        self._groups = defaultdict(set)
+        self._workers = []
+        self._context = multiprocessing.get_context("spawn")
+
+    def start(self, processes: int):
+        """
+        Starts the worker processes. Without any processes, jobs run directly in the greenlet submitting them.
+
+        :param processes: the amount of worker processes.
+        """
+        for _ in range(processes):
+            self._workers.append(gevent.spawn(self._serve))
+
+    def submit(self, function, *args, group=None, timeout=None) -> AsyncResult:
+        """
+        Queues a job for the workers.
+
+        :param function: a picklable function to call in the worker.
+        :param args: picklable arguments of the function.
+        :param group: key to cancel the job with, such as the room it belongs to.
+        :param timeout: seconds the job may take after it has been started, after that the worker is restarted.
+        :return: the result, which raises JobCancelled, JobTimeout or WorkerError if the job did not finish.
+        """
+        job = _Job(function, args, group, timeout)
+
+        if not self._workers:
+            try:
+                job.result.set(function(*args))
+            except Exception as e:
+                job.result.set_exception(e)
+            return job.result
+
+        if group is not None:
+            self._groups[group].add(job)
+        self._jobs.put(job)
+        return job.result
+
+    def run(self, function, *args, group=None, timeout=None):
+        """
+        Submits a job and waits for its result.
+        """
+        return self.submit(function, *args, group=group, timeout=timeout).get()
+
+    def cancel(self, group):
+        """
+        Cancels all jobs of a group. Queued jobs will not be started, and results of running jobs are discarded.
+
+        :param group:
+        """
+        for job in self._groups.pop(group, ()):
+            if not job.result.ready():
+                job.result.set_exception(JobCancelled())
+
+    def _spawn_process(self):
+        # One way pipes, as the sockets of a duplex pipe would be made non-blocking by gevent, also for the worker.
+        jobs_reader, jobs = self._context.Pipe(duplex=False)
+        results, results_writer = self._context.Pipe(duplex=False)
+
+        process = self._context.Process(target=_work, args=(jobs_reader, results_writer), daemon=True)
+        process.start()
+
+        jobs_reader.close()
+        results_writer.close()
+        return process, jobs, results
+
+    def _serve(self):
+        process, jobs, results = self._spawn_process()
+
+        while True:
+            job = self._jobs.get()
+            # The job was cancelled while it was waiting.
+            if job.result.ready():
+                continue
+
+            try:
+                jobs.send((job.function, job.args))
+                wait_read(results.fileno(), timeout=job.timeout,
+                          timeout_exc=JobTimeout("Job did not finish within %s seconds." % job.timeout))
+                success, value = results.recv()
+            except Exception as e:
+                # The worker is either stuck or gone, so replace it.
+                process.terminate()
+                process.join()
+                jobs.close()
+                results.close()
+                process, jobs, results = self._spawn_process()
+
+                self._finish(job, exception=e)
+                continue
+
+            if success:
+                self._finish(job, value=value)
+            else:
+                self._finish(job, exception=WorkerError(value))
+
+    def _finish(self, job, value=None, exception=None):
+        jobs = self._groups.get(job.group)
+        if jobs is not None:
+            jobs.discard(job)
+            if not jobs:
+                del self._groups[job.group]
+
+        # A cancelled job already has a result.
+        if job.result.ready():
+            return
+
+        if exception is not None:
+            job.result.set_exception(exception)
+        else:
+            job.result.set(value)
+
+
+pool = WorkerPool()
+
+
+def init_workers(processes):
+    """
+    Start the worker processes of the pool.
+
+    :param processes: the amount of worker processes, 0 runs all jobs in the calling greenlet.
+    """
+    pool.start(processes)